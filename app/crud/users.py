@@ -78,3 +78,23 @@ class UsersCRUD(BaseCRUD):
         except Exception as e:
             self.session.rollback()
             raise BaseError("here" + str(e))
+
+    def update_profile(
+        self,
+        user_id: str,
+        username: str,
+        email: str,
+    ) -> None:
+        self.session.query(UserBase).filter(UserBase.user_id == user_id).update(
+            {
+                UserBase.username: username,
+                UserBase.email: email,
+            },
+            synchronize_session="fetch",
+        )
+
+        try:
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            raise BaseError(str(e))
@@ -9,17 +9,23 @@ from app.routers import playlists, users, websocket
 from app.utils.config import get_settings
 from app.utils.connection_manager import connection_manager
 from app.utils.errors import SOPApiError
+from app.utils.task_queue import task_queue
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     scheduler = AsyncIOScheduler()
-    delay = 300
     scheduler.add_job(
-        connection_manager.check_stale, "interval", seconds=delay, args=[delay]
+        connection_manager.check_stale,
+        "interval",
+        seconds=get_settings().websocket_stale_check_interval,
     )
     scheduler.start()
+    task_queue.start()
+    await connection_manager.start()
     yield
+    await connection_manager.stop()
+    await task_queue.stop(get_settings().task_queue_shutdown_timeout)
     scheduler.shutdown()
 
 
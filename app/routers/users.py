@@ -9,10 +9,13 @@ from app.crud.users import UsersCRUD
 from app.schemas.users import CallbackInput, GetUserInput, IsLoggedIn, User
 from app.utils.config import get_settings
 from app.utils.dependencies import (
+    get_current_user,
     get_is_user_logged_in,
     get_postgres_database,
+    get_postgres_session_factory,
     get_session_id,
     get_state,
+    get_task_queue,
     get_twitch_client,
 )
 from app.utils.errors import (
@@ -21,6 +24,8 @@ from app.utils.errors import (
     TwitchCallbackError,
     TwitchStatesError,
 )
+from app.utils.jobs import refresh_user_profile
+from app.utils.task_queue import TaskQueue
 from app.utils.twitch import TwitchClient
 
 router = APIRouter(tags=["Users"], prefix="/users")
@@ -51,6 +56,10 @@ async def callback(
     session_id: str = Depends(get_session_id),
     twitch_client: TwitchClient = Depends(get_twitch_client),
     postgres_database: Session = Depends(get_postgres_database),
+    postgres_session_factory: Callable[[], Session] = Depends(
+        get_postgres_session_factory
+    ),
+    task_queue: TaskQueue = Depends(get_task_queue),
 ) -> RedirectResponse:
     if callback_input.error:
         raise TwitchCallbackError
@@ -58,8 +67,10 @@ async def callback(
         raise TwitchStatesError
     if not request.cookies.get("state") == callback_input.state:
         raise PotentialCSRFError
-    user_id, token, refresh_token = await twitch_client.callback(callback_input.code)
-    username, email = await twitch_client.get_user(token, user_id)
+    user_id, login, token, refresh_token = await twitch_client.callback(
+        callback_input.code
+    )
+    # Only the session is written before redirecting, the profile comes later
     if UsersCRUD(postgres_database).exists_user(user_id):
         UsersCRUD(postgres_database).update_user(
             user_id=user_id,
@@ -70,12 +81,19 @@ async def callback(
     else:
         UsersCRUD(postgres_database).create_user(
             user_id=user_id,
-            email=email,
-            username=username,
+            email="",
+            username=login,
             token=token,
             refresh_token=refresh_token,
             session_id=session_id,
         )
+    task_queue.enqueue(
+        refresh_user_profile,
+        twitch_client,
+        postgres_session_factory,
+        token,
+        user_id,
+    )
     response = RedirectResponse(f"{get_settings().front_base_url}/callback")
     response.set_cookie(
         key="session_id", value=session_id, domain=get_settings().cookie_domain
@@ -107,3 +125,8 @@ async def get_user(
     postgres_database: Session = Depends(get_postgres_database),
 ) -> User:
     return UsersCRUD(postgres_database).get_user(get_user_input.session_id)[0]
+
+
+@router.get("/me")
+async def get_me(user: User = Depends(get_current_user)) -> User:
+    return user
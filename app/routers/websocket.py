@@ -1,30 +1,47 @@
+import asyncio
+import logging
+import secrets
 from typing import Callable
 
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, WebSocket, status
 from fastapi.params import Depends
-from pydantic import ValidationError
-from sqlalchemy.orm import Session
 
-from app.crud.users import UsersCRUD
-from app.schemas.websocket import PollInputType, WebSocketInput, WebSocketInputType
+from app.schemas.websocket import (
+    ConnectionStatus,
+    PollInput,
+    PollInputType,
+    PollOutputType,
+    WebSocketInputType,
+    parse_msgpack_websocket_input,
+    parse_websocket_input,
+)
+from app.utils import frames
+from app.utils.cache import IdempotencyCache
+from app.utils.concurrency import KeyedLimiter, TokenBucket
+from app.utils.config import get_settings
 from app.utils.connection_manager import ConnectionManager
 from app.utils.dependencies import (
     get_connection_manager,
-    get_is_user_logged_in,
-    get_postgres_database,
+    get_eventsub_manager,
+    get_poll_starts,
+    get_poll_watcher,
     get_twitch_client,
+    get_user_limiter,
+    get_user_resolver,
 )
 from app.utils.errors import (
-    IncorrectPayloadError,
-    IncorrectWebsocketInputError,
-    MissingPayloadError,
-    MissingTypeFieldError,
-    NotLoggedInError,
-    PollNotFoundError,
-    UnknownTypeFieldError,
+    BaseError,
+    FrameTooLargeError,
+    SOPApiError,
+    TooManyMessagesError,
 )
+from app.utils.eventsub import EventSubManager
+from app.utils.frames import Frame
+from app.utils.poll_watcher import PollWatcher
 from app.utils.twitch import TwitchClient
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(tags=["Websocket"], prefix="/websocket")
 
 
@@ -32,112 +49,211 @@ router = APIRouter(tags=["Websocket"], prefix="/websocket")
 async def connect_websocket(
     websocket: WebSocket,
     twitch_client: TwitchClient = Depends(get_twitch_client),
-    postgres_database: Session = Depends(get_postgres_database),
-    is_user_logged_in: Callable = Depends(get_is_user_logged_in),
+    resolve_user: Callable = Depends(get_user_resolver),
     connection_manager: ConnectionManager = Depends(get_connection_manager),
+    poll_watcher: PollWatcher = Depends(get_poll_watcher),
+    eventsub_manager: EventSubManager = Depends(get_eventsub_manager),
+    user_limiter: KeyedLimiter = Depends(get_user_limiter),
+    poll_starts: IdempotencyCache = Depends(get_poll_starts),
 ):
-    is_logged_in = await is_user_logged_in(websocket)
-    if not is_logged_in["is_logged_in"]:
-        raise NotLoggedInError()
-
     session_id = websocket.cookies.get("session_id")
-    user = UsersCRUD(postgres_database).get_user(session_id)[0]
+    resume_token = websocket.query_params.get("resume_token")
+    try:
+        last_seq = int(websocket.query_params.get("last_seq", 0))
+    except ValueError:
+        last_seq = -1
+    connection = None
+    # A malformed last_seq starts a fresh connection
+    if session_id and resume_token and last_seq >= 0:
+        connection = await connection_manager.resume(
+            session_id, websocket, resume_token, last_seq
+        )
 
-    await connection_manager.connect(session_id, websocket)
+    if connection:
+        user, connection_id = connection.user, connection.connection_id
+    else:
+        # Resumed connections skip this, so it is not a route dependency
+        user = await resolve_user(websocket)
+        connection_id = await connection_manager.connect(
+            session_id,
+            websocket,
+            user,
+            resumable="resume" in websocket.query_params or bool(resume_token),
+            delta="delta" in websocket.query_params,
+        )
+        connection_manager.subscribe(user.user_id, session_id, connection_id)
+        if get_settings().eventsub_enabled:
+            eventsub_manager.add_session(
+                twitch_client, user.token, user.user_id, session_id
+            )
 
-    alive = True
-    while alive:
-        data = await websocket.receive_json()
+    async def reply(frame: Frame, request_id: str | None):
+        await connection_manager.send_frame(
+            session_id, frames.reply(frame, request_id), connection_id
+        )
+
+    async def publish(frame: Frame, request_id: str | None):
+        # The requester gets its own copy tagged with the request id
+        await reply(frame, request_id)
+        await connection_manager.broadcast_frame(
+            user.user_id, frame, exclude=connection_id
+        )
+
+    async def handle_poll(payload: PollInput, request_id: str | None):
         try:
-            data = WebSocketInput.model_validate(data)
-        except IncorrectWebsocketInputError:
-            payload = IncorrectWebsocketInputError().json()
-            await connection_manager.send_json(session_id, payload)
-        except MissingPayloadError:
-            payload = MissingPayloadError().json()
-            await connection_manager.send_json(session_id, payload)
-        except MissingTypeFieldError:
-            payload = MissingTypeFieldError().json()
-            await connection_manager.send_json(session_id, payload)
-        except UnknownTypeFieldError:
-            payload = UnknownTypeFieldError().json()
-            await connection_manager.send_json(session_id, payload)
-        except ValidationError:
-            payload = IncorrectPayloadError().json()
-            await connection_manager.send_json(session_id, payload)
-        else:
-            payload = data.payload
-            match payload.type:
-                case WebSocketInputType.DISCONNECT:
-                    alive = False
-                    await connection_manager.send_json(
-                        session_id,
-                        {
-                            "type": "connection_status",
-                            "status": "disconnected",
-                        },
-                    )
-                    await connection_manager.disconnect(session_id)
-                case WebSocketInputType.POLL:
-                    match payload.data.type:
-                        case PollInputType.START:
+            match payload.data.type:
+                case PollInputType.START:
+                    start_data = payload.data.data
+
+                    async def start_poll() -> dict:
+                        async with user_limiter.acquire(user.user_id):
                             poll = await twitch_client.create_poll(
                                 token=user.token,
                                 user_id=user.user_id,
-                                title=payload.data.data.title,
-                                choices=payload.data.data.choices,
+                                title=start_data.title,
+                                choices=start_data.choices,
+                                duration=start_data.duration,
                             )
-                            await connection_manager.send_json(
+                        # Fanned out inside the shared call, so a duplicate
+                        # start only gets its reply
+                        await connection_manager.broadcast_frame(
+                            user.user_id,
+                            frames.poll(PollOutputType.START, poll),
+                            exclude=connection_id,
+                        )
+                        if not get_settings().eventsub_enabled:
+                            poll_watcher.start(
                                 session_id,
-                                {
-                                    "type": "poll",
-                                    "data": {
-                                        "type": "start",
-                                        "data": poll,
-                                    },
-                                },
+                                twitch_client,
+                                token=user.token,
+                                user_id=user.user_id,
+                                poll_id=poll["poll_id"],
+                                duration=start_data.duration,
                             )
-                        case PollInputType.GET:
-                            try:
-                                poll = await twitch_client.get_poll(
-                                    token=user.token,
-                                    user_id=user.user_id,
-                                    poll_id=payload.data.data.poll_id,
-                                )
-                            except PollNotFoundError:
-                                await connection_manager.send_json(
-                                    session_id, PollNotFoundError().json()
-                                )
-                            else:
-                                await connection_manager.send_json(
-                                    session_id,
-                                    {
-                                        "type": "poll",
-                                        "data": {
-                                            "type": "get",
-                                            "data": poll,
-                                        },
-                                    },
-                                )
-                        case PollInputType.END:
-                            try:
-                                poll = await twitch_client.end_poll(
-                                    token=user.token,
-                                    user_id=user.user_id,
-                                    poll_id=payload.data.data.poll_id,
-                                )
-                            except PollNotFoundError:
-                                await connection_manager.send_json(
-                                    session_id, PollNotFoundError().json()
-                                )
-                            else:
-                                await connection_manager.send_json(
-                                    session_id,
-                                    {
-                                        "type": "poll",
-                                        "data": {
-                                            "type": "end",
-                                            "data": poll,
-                                        },
-                                    },
-                                )
+                        return poll
+
+                    if start_data.idempotency_key:
+                        poll = await poll_starts.run(
+                            (user.user_id, start_data.idempotency_key),
+                            start_poll,
+                        )
+                    else:
+                        poll = await start_poll()
+                    await reply(frames.poll(PollOutputType.START, poll), request_id)
+                case PollInputType.GET:
+                    async with user_limiter.acquire(user.user_id):
+                        poll = await twitch_client.get_poll(
+                            token=user.token,
+                            user_id=user.user_id,
+                            poll_id=payload.data.data.poll_id,
+                        )
+                    await reply(frames.poll(PollOutputType.GET, poll), request_id)
+                case PollInputType.END:
+                    async with user_limiter.acquire(user.user_id):
+                        poll = await twitch_client.end_poll(
+                            token=user.token,
+                            user_id=user.user_id,
+                            poll_id=payload.data.data.poll_id,
+                        )
+                    await publish(frames.poll(PollOutputType.END, poll), request_id)
+        except SOPApiError as error:
+            await reply(frames.error(error), request_id)
+        except Exception:
+            # Nobody awaits the task, the request still gets an answer
+            logger.exception(f"Websocket {payload.data.type.value} poll failed")
+            await reply(frames.error(BaseError("Unexpected error")), request_id)
+        finally:
+            in_flight.release()
+
+    # Each poll message runs as its own task so a slow Twitch call does not
+    # hold the next message, reading stops once too many are in flight
+    settings = get_settings()
+    in_flight = asyncio.Semaphore(settings.websocket_max_in_flight)
+    bucket = TokenBucket(settings.websocket_rate, settings.websocket_burst)
+    tasks: set[asyncio.Task] = set()
+    alive = True
+    try:
+        while alive:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            connection_manager.update_activity(session_id, connection_id)
+            # Checked before any decoding, each message may cost a Twitch call
+            if message.get("text") is not None:
+                size = len(message["text"].encode())
+            else:
+                size = len(message.get("bytes") or b"")
+            if size > settings.websocket_max_frame_size:
+                abuse = FrameTooLargeError()
+                close_code = status.WS_1009_MESSAGE_TOO_BIG
+            elif not bucket.consume():
+                abuse = TooManyMessagesError()
+                close_code = status.WS_1008_POLICY_VIOLATION
+            else:
+                abuse = None
+            if abuse:
+                await connection_manager.send_frame(
+                    session_id, frames.error(abuse), connection_id
+                )
+                if settings.websocket_abuse_policy == "disconnect":
+                    await connection_manager.disconnect(
+                        session_id, connection_id, close_code
+                    )
+                    break
+                continue
+            try:
+                # Binary frames come from msgpack clients
+                if message.get("bytes") is not None:
+                    data = parse_msgpack_websocket_input(message["bytes"])
+                else:
+                    data = parse_websocket_input(message["text"])
+            except SOPApiError as error:
+                await connection_manager.send_frame(
+                    session_id, frames.error(error), connection_id
+                )
+            else:
+                match data.payload.type:
+                    case WebSocketInputType.DISCONNECT:
+                        alive = False
+                        await reply(
+                            frames.connection_status(ConnectionStatus.DISCONNECTED),
+                            data.request_id,
+                        )
+                        await connection_manager.disconnect(session_id, connection_id)
+                    case WebSocketInputType.POLL:
+                        await in_flight.acquire()
+                        task = asyncio.create_task(
+                            handle_poll(data.payload, data.request_id)
+                        )
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Poll updates stop once the last connection of the session is gone
+        await connection_manager.release(session_id, connection_id, websocket)
+
+
+@router.websocket("/watch/{broadcaster_id}")
+async def watch_websocket(
+    websocket: WebSocket,
+    broadcaster_id: str,
+    connection_manager: ConnectionManager = Depends(get_connection_manager),
+):
+    # Viewers and overlays are anonymous: they only receive the room's polls
+    session_id = f"watch:{secrets.token_hex(16)}"
+    connection_id = await connection_manager.connect(
+        session_id,
+        websocket,
+        delta="delta" in websocket.query_params,
+        idle_timeout=False,
+    )
+    connection_manager.subscribe(broadcaster_id, session_id, connection_id)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            connection_manager.update_activity(session_id, connection_id)
+    finally:
+        connection_manager.remove(session_id, connection_id)
@@ -1,25 +1,57 @@
+import asyncio
 from enum import Enum
-from typing import Annotated, Any, Literal
+from typing import Annotated, Any, Literal, Optional
 
+import msgpack
 from fastapi import WebSocket
-from pydantic import BaseModel, ConfigDict, Field, model_validator
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    TypeAdapter,
+    ValidationError,
+    model_validator,
+)
 
+from app.schemas.users import User
 from app.utils.errors import (
+    IncorrectPayloadError,
     IncorrectWebsocketInputError,
     IncorrectWebsocketOutputError,
     MissingPayloadError,
     MissingTypeFieldError,
+    SOPApiError,
     UnknownTypeFieldError,
 )
+from app.utils.send_queue import ReplayBuffer, SendQueue
 
 # MARK: -MANAGER
 
 
 class ActiveConnection(BaseModel):
+    session_id: str
+    connection_id: str
     websocket: WebSocket
     last_seen: float
+    queue: SendQueue
+    writer: Optional[asyncio.Task] = None
+    rooms: set[str] = set()
+    user: Optional[User] = None
+    # Only set on connections that opted in to resume
+    replay: Optional[ReplayBuffer] = None
+    detached_at: Optional[float] = None
+    # Receive-only connections (watchers) never send, so they never go idle
+    idle_timeout: bool = True
+    subprotocol: Optional[str] = None
+    # Delta mode: poll snapshot key -> (votes, status) last sent on this connection
+    delta: bool = False
+    poll_snapshots: dict[str, tuple[tuple[int, ...], str]] = {}
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
 
 # MARK: -INPUT - Poll
 
@@ -41,6 +73,8 @@ class PollStartInputData(BaseModel):
         min_length=2, max_length=5
     )
     duration: int = Field(60, ge=15, le=1800)
+    # Client generated, duplicate starts with the same key create a single poll
+    idempotency_key: Optional[str] = Field(None, max_length=64)
 
 
 class PollStartInput(BaseModel):
@@ -86,24 +120,57 @@ class DisconnectInput(BaseModel):
 
 class PollInput(BaseModel):
     type: Literal[WebSocketInputType.POLL]
-    data: PollStartInput | PollEndInput | PollGetInput
+    data: Annotated[
+        PollStartInput | PollEndInput | PollGetInput, Field(discriminator="type")
+    ]
 
 
 class WebSocketInput(BaseModel):
-    payload: DisconnectInput | PollInput
-
-    @model_validator(mode="before")
-    @classmethod
-    def check_type(cls, data: Any) -> Any:
-        if not isinstance(data, dict):
-            raise IncorrectWebsocketInputError()
-        if isinstance(data, dict) and not (payload := data.get("payload")):
-            raise MissingPayloadError()
-        if isinstance(payload, dict) and not (payload_type := payload.get("type")):
-            raise MissingTypeFieldError()
-        if payload_type not in WebSocketInputType:
-            raise UnknownTypeFieldError()
-        return data
+    payload: Annotated[DisconnectInput | PollInput, Field(discriminator="type")]
+    # Client chosen, echoed back on the replies to this message
+    request_id: Optional[str] = Field(None, max_length=64)
+
+
+websocket_input_adapter = TypeAdapter(WebSocketInput)
+
+
+def parse_websocket_input(data: str | bytes) -> WebSocketInput:
+    # Tagged unions pick the model from "type" : one pass, no trial matching
+    try:
+        return websocket_input_adapter.validate_json(data)
+    except ValidationError as validation_error:
+        raise input_error(validation_error)
+
+
+def parse_msgpack_websocket_input(data: bytes) -> WebSocketInput:
+    try:
+        decoded = msgpack.unpackb(data)
+    except ValueError:
+        raise IncorrectWebsocketInputError()
+    try:
+        return websocket_input_adapter.validate_python(decoded)
+    except ValidationError as validation_error:
+        raise input_error(validation_error)
+
+
+def input_error(validation_error: ValidationError) -> SOPApiError:
+    error = validation_error.errors()[0]
+    match error["type"], error["loc"]:
+        case ("json_invalid" | "model_type", ()):
+            return IncorrectWebsocketInputError()
+        case ("missing", ("payload",)):
+            return MissingPayloadError()
+        case (_, ("payload",)) if not error["input"]:
+            return MissingPayloadError()
+        case ("union_tag_not_found", ("payload",)):
+            return MissingTypeFieldError()
+        case ("union_tag_invalid", ("payload",)) if not error["input"].get("type"):
+            # A null or empty type counts as missing
+            return MissingTypeFieldError()
+        case ("union_tag_invalid", ("payload",)):
+            return UnknownTypeFieldError()
+        case _:
+            return IncorrectPayloadError()
 
 
 # MARK: -OUTPUT - Poll
@@ -113,6 +180,7 @@ class PollOutputType(str, Enum):
     START = "start"
     END = "end"
     GET = "get"
+    DELTA = "delta"
 
 
 class PollStatus(str, Enum):
@@ -156,6 +224,21 @@ class PollGetOutput(BaseModel):
     data: PollGetOutputData
 
 
+# MARK: Poll - Delta
+
+
+class PollDeltaOutputData(BaseModel):
+    poll_id: str
+    # Choice index -> new vote count, only for choices that changed
+    votes: dict[int, int]
+    status: PollStatus
+
+
+class PollDeltaOutput(BaseModel):
+    type: Literal[PollOutputType.DELTA]
+    data: PollDeltaOutputData
+
+
 # MARK: Poll - End
 
 
@@ -188,6 +271,8 @@ class ConnectionStatus(str, Enum):
 class ConnectionStatusOutput(BaseModel):
     type: Literal[WebSocketOutputType.CONNECTION_STATUS]
     status: ConnectionStatus
+    resume_token: Optional[str] = None
+    resumed: Optional[bool] = None
 
 
 class ErrorOutput(BaseModel):
@@ -199,11 +284,13 @@ class ErrorOutput(BaseModel):
 
 class PollOutput(BaseModel):
     type: Literal[WebSocketOutputType.POLL]
-    data: PollStartOutput | PollGetOutput | PollEndOutput
+    data: PollStartOutput | PollGetOutput | PollDeltaOutput | PollEndOutput
 
 
 class WebSocketOutput(BaseModel):
     payload: ConnectionStatusOutput | ErrorOutput | PollOutput
+    request_id: Optional[str] = None
+    seq: Optional[int] = None
 
     @model_validator(mode="before")
     @classmethod
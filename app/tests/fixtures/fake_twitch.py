@@ -0,0 +1,267 @@
+import asyncio
+import math
+import random
+import time
+from typing import Annotated, Any
+from urllib.parse import parse_qs, urlencode
+
+from fastapi import FastAPI, Header, Query, Request
+from fastapi.responses import JSONResponse, RedirectResponse
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+# Local stand-in for the Twitch OAuth and Helix APIs, for tests and load runs :
+#   uvicorn app.tests.fixtures.fake_twitch:app --port 8080
+#   TWITCH_ID_BASE_URL=http://localhost:8080 TWITCH_API_BASE_URL=http://localhost:8080
+
+
+class FakeTwitchSettings(BaseSettings):
+    # Added to every response, in seconds
+    latency: float = 0.0
+    # Share of requests answered with a 503
+    error_rate: float = 0.0
+    # Helix points per minute and per token, as Twitch does
+    rate_limit: int = 800
+    # Votes added to a random choice on each poll read
+    votes_per_read: int = 3
+    model_config = SettingsConfigDict(env_prefix="FAKE_TWITCH_", extra="ignore")
+
+
+class FakeTwitchState:
+    def __init__(self):
+        self.polls: dict[str, dict] = {}
+        self.buckets: dict[str, tuple[float, float]] = {}
+        self.poll_count = 0
+
+    def take_point(self, key: str, rate_limit: int) -> tuple[bool, int, int]:
+        # Token bucket refilled over a minute
+        now = time.time()
+        tokens, updated_at = self.buckets.get(key, (rate_limit, now))
+        tokens = min(rate_limit, tokens + (now - updated_at) * rate_limit / 60)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        reset = now + (rate_limit - tokens) * 60 / rate_limit
+        return allowed, math.floor(tokens), math.ceil(reset)
+
+
+def user_from_token(authorization: str | None) -> str | None:
+    if not authorization or not authorization.startswith("Bearer token-"):
+        return None
+    return authorization.removeprefix("Bearer token-")
+
+
+def unauthorized() -> JSONResponse:
+    return JSONResponse(
+        status_code=401,
+        content={"error": "Unauthorized", "status": 401, "message": "Invalid token"},
+    )
+
+
+def poll_output(poll: dict) -> dict:
+    return {key: value for key, value in poll.items() if key != "started_at_monotonic"}
+
+
+def refresh_status(poll: dict):
+    if (
+        poll["status"] == "ACTIVE"
+        and time.monotonic() - poll["started_at_monotonic"] > poll["duration"]
+    ):
+        poll["status"] = "COMPLETED"
+
+
+async def read_body(request: Request) -> dict[str, Any]:
+    # JSON, or form fields with repeated keys gathered in lists
+    if request.headers.get("Content-Type", "").startswith("application/json"):
+        return await request.json()
+    form = parse_qs((await request.body()).decode())
+    return {
+        key: values if len(values) > 1 else values[0] for key, values in form.items()
+    }
+
+
+def bad_request(message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=400,
+        content={"error": "Bad Request", "status": 400, "message": message},
+    )
+
+
+async def read_json_body(request: Request) -> dict[str, Any] | None:
+    # Helix only takes JSON bodies, unlike the OAuth endpoints
+    if not request.headers.get("Content-Type", "").startswith("application/json"):
+        return None
+    return await request.json()
+
+
+def create_fake_twitch_app(settings: FakeTwitchSettings | None = None) -> FastAPI:
+    settings = settings or FakeTwitchSettings()
+    state = FakeTwitchState()
+    fake_app = FastAPI()
+    fake_app.state.settings = settings
+    fake_app.state.twitch = state
+
+    @fake_app.middleware("http")
+    async def simulate_network(request: Request, call_next):
+        if settings.latency:
+            await asyncio.sleep(settings.latency)
+        if random.random() < settings.error_rate:
+            return JSONResponse(status_code=503, content={"error": "Unavailable"})
+        if not request.url.path.startswith("/helix"):
+            return await call_next(request)
+
+        key = request.headers.get("Authorization", "anonymous")
+        allowed, remaining, reset = state.take_point(key, settings.rate_limit)
+        headers = {
+            "Ratelimit-Limit": str(settings.rate_limit),
+            "Ratelimit-Remaining": str(remaining),
+            "Ratelimit-Reset": str(reset),
+        }
+        if not allowed:
+            return JSONResponse(
+                status_code=429,
+                content={"error": "Too Many Requests", "status": 429},
+                headers=headers,
+            )
+        response = await call_next(request)
+        response.headers.update(headers)
+        return response
+
+    # MARK: OAuth
+
+    @fake_app.get("/oauth2/authorize")
+    async def authorize(
+        redirect_uri: str, state: str = "", client_id: str = ""
+    ) -> RedirectResponse:
+        code = str(random.randint(1, 10**9))
+        return RedirectResponse(
+            f"{redirect_uri}?{urlencode({'code': code, 'state': state})}"
+        )
+
+    @fake_app.post("/oauth2/token")
+    async def token(request: Request) -> dict:
+        code = (await read_body(request))["code"]
+        return {
+            "access_token": f"token-{code}",
+            "expires_in": 14124,
+            "refresh_token": f"refresh-{code}",
+            "scope": ["channel:manage:polls", "user:read:email"],
+            "token_type": "bearer",
+        }
+
+    @fake_app.get("/oauth2/validate")
+    async def validate(authorization: Annotated[str | None, Header()] = None):
+        if (user_id := user_from_token(authorization)) is None:
+            return unauthorized()
+        return {
+            "client_id": "fake",
+            "login": f"user{user_id}",
+            "scopes": ["channel:manage:polls", "user:read:email"],
+            "user_id": user_id,
+            "expires_in": 14124,
+        }
+
+    # MARK: Helix
+
+    @fake_app.get("/helix/users")
+    async def get_users(
+        id: str | None = None,
+        authorization: Annotated[str | None, Header()] = None,
+    ):
+        if (user_id := user_from_token(authorization)) is None:
+            return unauthorized()
+        user_id = id or user_id
+        return {
+            "data": [
+                {
+                    "id": user_id,
+                    "login": f"user{user_id}",
+                    "display_name": f"User{user_id}",
+                    "type": "",
+                    "broadcaster_type": "",
+                    "description": "",
+                    "profile_image_url": "",
+                    "offline_image_url": "",
+                    "view_count": 0,
+                    "email": f"user{user_id}@example.com",
+                    "created_at": "2016-12-14T20:32:28Z",
+                }
+            ]
+        }
+
+    @fake_app.post("/helix/polls")
+    async def create_poll(
+        request: Request, authorization: Annotated[str | None, Header()] = None
+    ):
+        if user_from_token(authorization) is None:
+            return unauthorized()
+        if (body := await read_json_body(request)) is None:
+            return bad_request("Content-Type must be application/json")
+        state.poll_count += 1
+        poll_id = f"poll{state.poll_count}"
+        state.polls[poll_id] = {
+            "id": poll_id,
+            "broadcaster_id": body["broadcaster_id"],
+            "title": body["title"],
+            "choices": [
+                {"id": f"choice{i}", "title": choice["title"], "votes": 0}
+                for i, choice in enumerate(body["choices"], start=1)
+            ],
+            "status": "ACTIVE",
+            "duration": int(body.get("duration", 60)),
+            "started_at_monotonic": time.monotonic(),
+        }
+        return {"data": [poll_output(state.polls[poll_id])]}
+
+    @fake_app.get("/helix/polls")
+    async def get_polls(
+        broadcaster_id: str,
+        id: Annotated[list[str], Query()] = [],
+        authorization: Annotated[str | None, Header()] = None,
+    ):
+        if user_from_token(authorization) is None:
+            return unauthorized()
+        polls = [
+            poll
+            for poll in state.polls.values()
+            if poll["broadcaster_id"] == broadcaster_id and (not id or poll["id"] in id)
+        ]
+        for poll in polls:
+            refresh_status(poll)
+            if poll["status"] == "ACTIVE" and settings.votes_per_read:
+                random.choice(poll["choices"])["votes"] += random.randint(
+                    0, settings.votes_per_read
+                )
+        return {"data": [poll_output(poll) for poll in polls], "pagination": {}}
+
+    @fake_app.patch("/helix/polls")
+    async def end_poll(
+        request: Request, authorization: Annotated[str | None, Header()] = None
+    ):
+        if user_from_token(authorization) is None:
+            return unauthorized()
+        if (body := await read_json_body(request)) is None:
+            return bad_request("Content-Type must be application/json")
+        poll = state.polls.get(body["id"])
+        if poll is None or poll["broadcaster_id"] != body["broadcaster_id"]:
+            return JSONResponse(
+                status_code=404, content={"error": "Not Found", "status": 404}
+            )
+        refresh_status(poll)
+        if poll["status"] == "ACTIVE":
+            poll["status"] = body["status"]
+        return {"data": [poll_output(poll)]}
+
+    @fake_app.post("/helix/eventsub/subscriptions", status_code=202)
+    async def create_subscription(
+        request: Request, authorization: Annotated[str | None, Header()] = None
+    ):
+        if user_from_token(authorization) is None:
+            return unauthorized()
+        body = await request.json()
+        return {"data": [{"id": str(random.randint(1, 10**9)), **body}]}
+
+    return fake_app
+
+
+app = create_fake_twitch_app()
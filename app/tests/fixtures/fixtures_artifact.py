@@ -1,4 +1,4 @@
-from typing import Generator
+from typing import Callable, Generator
 
 from pytest import Session
 from sqlalchemy import StaticPool, create_engine
@@ -13,15 +13,16 @@ TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engin
 
 
 class FakeTwitchClient(TwitchClient):
-    async def callback(code: str) -> tuple[str, str, str]:
+    async def callback(code: str) -> tuple[str, str, str, str]:
         # Always returns user3
         token = "token3"
         refresh_token = "refresh_token3"
         # expires_in = data["expires_in"]
 
         user_id = "3"
+        login = "3"
 
-        return user_id, token, refresh_token
+        return user_id, login, token, refresh_token
 
     async def is_token_valid(token: str, user_id: str) -> bool:
         return "expired" not in token
@@ -57,13 +58,16 @@ class FakeTwitchClient(TwitchClient):
             "status": "TERMINATED",
         }
 
-    # TODO custom duration
     async def create_poll(
         token: str, user_id: str, title: str, choices: list[str], duration: int = 60
     ) -> dict:
         return {"poll_id": "poll1"}
 
 
+def override_get_postgres_session_factory() -> Callable[[], Session]:
+    return TestingSessionLocal
+
+
 def override_get_postgres_manager() -> Generator[Session]:
     try:
         postgres_database = TestingSessionLocal()
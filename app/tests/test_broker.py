@@ -0,0 +1,157 @@
+import asyncio
+import json
+import socket
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+
+from app.tests.test_connection_manager import FakeWebSocket, poll_payload
+from app.utils import broker as broker_module
+from app.utils.broker import PostgresBroker
+from app.utils.config import get_settings
+from app.utils.connection_manager import ConnectionManager
+
+
+class FakeCursor:
+    def __init__(self, connection: "FakeConnection"):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query: str, params: tuple = ()):
+        if self.connection.lost:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.connection.executed.append((query, params))
+
+
+class FakeConnection:
+    def __init__(self):
+        # A real socket so that the loop can watch it
+        self.socket, self.peer = socket.socketpair()
+        self.notifies = []
+        self.executed = []
+        self.closed = False
+        self.lost = False
+
+    def set_isolation_level(self, level: int):
+        pass
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    def poll(self):
+        self.socket.recv(1024)
+        if self.lost:
+            raise psycopg2.OperationalError("server closed the connection")
+
+    def close(self):
+        self.closed = True
+        self.socket.close()
+        self.peer.close()
+
+    def notify(self, payload: dict):
+        self.notifies.append(SimpleNamespace(payload=json.dumps(payload)))
+        self.peer.send(b"x")
+
+
+@pytest.fixture
+def connections(monkeypatch) -> list[FakeConnection]:
+    connections = []
+
+    def connect(dsn: str) -> FakeConnection:
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(broker_module.psycopg2, "connect", connect)
+    monkeypatch.setattr(get_settings(), "broker_reconnect_delay", 0)
+    return connections
+
+
+@pytest.mark.asyncio
+async def test_postgres_broker_receives_notifications(connections):
+    received = []
+
+    async def handler(message: dict):
+        received.append(message)
+
+    broker = PostgresBroker("dsn", "channel")
+    await broker.start(handler)
+    listen_connection, publish_connection = connections
+    assert listen_connection.executed == [('LISTEN "channel"', ())]
+
+    listen_connection.notify({"room": "1"})
+    await asyncio.sleep(0.01)
+    assert received == [{"room": "1"}]
+
+    await broker.publish({"room": "2"})
+    assert publish_connection.executed == [
+        ("SELECT pg_notify(%s, %s)", ("channel", '{"room": "2"}'))
+    ]
+    await broker.stop()
+    assert listen_connection.closed and publish_connection.closed
+
+
+@pytest.mark.asyncio
+async def test_postgres_broker_drops_oversized_messages(connections):
+    broker = PostgresBroker("dsn", "channel")
+    await broker.start(lambda message: None)
+    await broker.publish({"frame": "x" * PostgresBroker.max_payload_size})
+    assert connections[1].executed == []
+    await broker.stop()
+
+
+@pytest.mark.asyncio
+async def test_postgres_broker_reconnects_lost_listener(connections):
+    received = []
+
+    async def handler(message: dict):
+        received.append(message)
+
+    broker = PostgresBroker("dsn", "channel")
+    await broker.start(handler)
+    lost_connection = connections[0]
+    lost_connection.lost = True
+    lost_connection.peer.send(b"x")
+    await asyncio.sleep(0.01)
+    assert lost_connection.closed
+    assert broker.reconnect_task is None
+
+    listen_connection = connections[-1]
+    assert listen_connection.executed == [('LISTEN "channel"', ())]
+    listen_connection.notify({"room": "1"})
+    await asyncio.sleep(0.01)
+    assert received == [{"room": "1"}]
+    await broker.stop()
+
+
+@pytest.mark.asyncio
+async def test_postgres_broker_reopens_dead_publish_connection(
+    connections, monkeypatch
+):
+    monkeypatch.setattr(get_settings(), "websocket_coalesce_window", 0)
+    manager = ConnectionManager(PostgresBroker("dsn", "channel"))
+    await manager.start()
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    manager.subscribe("1", "session_id1", connection_id)
+    connections[1].lost = True
+
+    # Local members still get the frame, only the publish is lost
+    await manager.broadcast("1", poll_payload("1", 1))
+    await manager.flush("session_id1")
+    assert websocket.sent[-1]["payload"] == poll_payload("1", 1)
+    assert connections[1].closed
+
+    await manager.broadcast("1", poll_payload("1", 2))
+    assert len(connections) == 3
+    _, (_, payload) = connections[-1].executed[0]
+    assert json.loads(payload)["room"] == "1"
+    await manager.stop()
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from app.utils.cache import IdempotencyCache
+from app.utils.concurrency import KeyedLimiter, TokenBucket
+
+
+@pytest.mark.asyncio
+async def test_keyed_limiter_limits_per_key():
+    limiter = KeyedLimiter(limit=2)
+    running = {"user1": 0, "user2": 0}
+    peaks = {"user1": 0, "user2": 0}
+
+    async def call(key: str):
+        async with limiter.acquire(key):
+            running[key] += 1
+            peaks[key] = max(peaks[key], running[key])
+            await asyncio.sleep(0.01)
+            running[key] -= 1
+
+    await asyncio.gather(*[call("user1") for _ in range(5)], call("user2"))
+    assert peaks == {"user1": 2, "user2": 1}
+    assert limiter.semaphores == {}
+    assert limiter.holders == {}
+
+
+def test_token_bucket_allows_burst_then_refills(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("app.utils.concurrency.time.monotonic", lambda: now[0])
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+    now[0] += 0.5
+    assert bucket.consume()
+    assert not bucket.consume()
+    now[0] += 60
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+@pytest.mark.asyncio
+async def test_idempotency_cache_runs_duplicates_once():
+    idempotency = IdempotencyCache(ttl=60)
+    calls = []
+
+    async def create_poll() -> dict:
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"poll_id": f"poll{len(calls)}"}
+
+    outputs = await asyncio.gather(
+        idempotency.run(("1", "key1"), create_poll),
+        idempotency.run(("1", "key1"), create_poll),
+    )
+    output = await idempotency.run(("1", "key1"), create_poll)
+    assert outputs == [{"poll_id": "poll1"}, {"poll_id": "poll1"}]
+    assert output == {"poll_id": "poll1"}
+    assert await idempotency.run(("1", "key2"), create_poll) == {"poll_id": "poll2"}
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_idempotency_cache_keeps_result_of_cancelled_caller():
+    idempotency = IdempotencyCache(ttl=60)
+    calls = []
+
+    async def create_poll() -> dict:
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"poll_id": f"poll{len(calls)}"}
+
+    caller = asyncio.create_task(idempotency.run(("1", "key1"), create_poll))
+    await asyncio.sleep(0)
+    caller.cancel()
+    await asyncio.sleep(0.02)
+    assert await idempotency.run(("1", "key1"), create_poll) == {"poll_id": "poll1"}
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_idempotency_cache_does_not_keep_failures():
+    idempotency = IdempotencyCache(ttl=60)
+    calls = []
+
+    async def create_poll() -> dict:
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("failure")
+        return {"poll_id": "poll1"}
+
+    with pytest.raises(RuntimeError):
+        await idempotency.run(("1", "key1"), create_poll)
+    assert await idempotency.run(("1", "key1"), create_poll) == {"poll_id": "poll1"}
+    assert len(calls) == 2
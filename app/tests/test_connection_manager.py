@@ -0,0 +1,553 @@
+import asyncio
+import json
+
+import msgpack
+import pytest
+import pytest_asyncio
+from fastapi import WebSocket
+
+from app.schemas.websocket import PollOutputType
+from app.utils import frames
+from app.utils.broker import InMemoryBroker
+from app.utils.config import get_settings
+from app.utils.connection_manager import ConnectionManager
+
+
+class FakeWebSocket(WebSocket):
+    def __init__(self, subprotocols: list[str] | None = None):
+        self.scope = {"type": "websocket", "subprotocols": subprotocols or []}
+        self.sent: list[dict] = []
+        self.closed = False
+        self.subprotocol = None
+
+    async def accept(self, subprotocol: str | None = None, *args, **kwargs):
+        self.subprotocol = subprotocol
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data: bytes):
+        self.sent.append(msgpack.unpackb(data))
+
+    async def close(self, *args, **kwargs):
+        self.closed = True
+
+
+class SlowWebSocket(FakeWebSocket):
+    def __init__(self):
+        super().__init__()
+        self.unblock = asyncio.Event()
+
+    async def send_text(self, data: str):
+        await self.unblock.wait()
+        self.sent.append(json.loads(data))
+
+
+class BrokenWebSocket(FakeWebSocket):
+    async def send_text(self, data: str):
+        raise RuntimeError("socket is gone")
+
+
+def poll_payload(poll_id: str, votes: int) -> dict:
+    return {
+        "type": "poll",
+        "data": {
+            "type": "get",
+            "data": {
+                "poll_id": poll_id,
+                "title": "title",
+                "choices": [{"title": "choice", "votes": votes}],
+                "status": "ACTIVE",
+            },
+        },
+    }
+
+
+@pytest_asyncio.fixture
+async def workers():
+    broker = InMemoryBroker()
+    managers = [ConnectionManager(broker), ConnectionManager(broker)]
+    for manager in managers:
+        await manager.start()
+    yield managers
+    for manager in managers:
+        await manager.stop()
+
+
+# MARK: Broker
+
+
+@pytest.mark.asyncio
+async def test_send_json_reaches_socket_held_by_another_worker(workers):
+    first_worker, second_worker = workers
+    websocket = FakeWebSocket()
+    await first_worker.connect("session_id1", websocket)
+
+    await second_worker.send_json(
+        "session_id1", {"type": "connection_status", "status": "connected"}
+    )
+    await first_worker.flush("session_id1")
+    assert websocket.sent == [
+        {"payload": {"type": "connection_status", "status": "connected"}},
+        {"payload": {"type": "connection_status", "status": "connected"}},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_json_to_unknown_session_is_dropped(workers):
+    first_worker, second_worker = workers
+    websocket = FakeWebSocket()
+    await first_worker.connect("session_id1", websocket)
+
+    await second_worker.send_json(
+        "session_id2", {"type": "connection_status", "status": "connected"}
+    )
+    await first_worker.flush("session_id1")
+    assert len(websocket.sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_same_snapshot_from_two_workers_is_sent_once(workers):
+    first_worker, second_worker = workers
+    websocket = FakeWebSocket()
+    connection_id = await first_worker.connect("session_id1", websocket)
+    first_worker.subscribe("1", "session_id1", connection_id)
+
+    # Each worker runs its own EventSub listener for the streamer
+    frame = frames.poll(PollOutputType.GET, poll_payload("1", 1)["data"]["data"])
+    await second_worker.broadcast_frame("1", frame)
+    await first_worker.broadcast_frame("1", frame)
+    await first_worker.flush("session_id1")
+    assert len(websocket.sent) == 2
+
+
+# MARK: Send queue
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_keeps_latest_frames(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_send_queue_size", 2)
+    monkeypatch.setattr(get_settings(), "websocket_overflow_policy", "drop_oldest")
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = SlowWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    await asyncio.sleep(0)
+
+    for votes in range(4):
+        await manager.send_json("session_id1", poll_payload(str(votes), votes))
+    assert manager.queue_depth("session_id1", connection_id) == 2
+
+    websocket.unblock.set()
+    await manager.flush("session_id1")
+    assert [
+        frame["payload"]["data"]["data"]["poll_id"] for frame in websocket.sent[1:]
+    ] == ["2", "3"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_replaces_queued_poll_snapshot(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_send_queue_size", 2)
+    monkeypatch.setattr(get_settings(), "websocket_overflow_policy", "coalesce")
+    monkeypatch.setattr(get_settings(), "websocket_coalesce_window", 0)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = SlowWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    await asyncio.sleep(0)
+
+    for poll_id, votes in (("1", 1), ("2", 1), ("1", 5)):
+        poll = poll_payload(poll_id, votes)["data"]["data"]
+        await manager.send_frame("session_id1", frames.poll(PollOutputType.GET, poll))
+    assert manager.queue_depths() == {connection_id: 2}
+
+    websocket.unblock.set()
+    await manager.flush("session_id1")
+    assert [frame["payload"]["data"]["data"] for frame in websocket.sent[1:]] == [
+        poll_payload("1", 5)["data"]["data"],
+        poll_payload("2", 1)["data"]["data"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_evicts_slow_consumer(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_send_queue_size", 1)
+    monkeypatch.setattr(get_settings(), "websocket_overflow_policy", "disconnect")
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = SlowWebSocket()
+    await manager.connect("session_id1", websocket)
+    await asyncio.sleep(0)
+
+    await manager.send_json("session_id1", poll_payload("1", 1))
+    await manager.send_json("session_id1", poll_payload("1", 2))
+    assert websocket.closed
+    assert "session_id1" not in manager.active_connections
+
+
+@pytest.mark.asyncio
+async def test_failed_send_removes_connection():
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = BrokenWebSocket()
+    await manager.connect("session_id1", websocket)
+    await asyncio.sleep(0)
+
+    assert websocket.closed
+    assert "session_id1" not in manager.active_connections
+
+
+@pytest.mark.asyncio
+async def test_disconnect_flushes_queue_before_closing():
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    await manager.send_json("session_id1", poll_payload("1", 1))
+
+    await manager.disconnect("session_id1", connection_id)
+    assert websocket.closed
+    assert websocket.sent[-1] == {
+        "payload": {"type": "connection_status", "status": "disconnected"}
+    }
+    assert len(websocket.sent) == 3
+
+
+# MARK: Stale connections
+
+
+@pytest.mark.asyncio
+async def test_check_stale_closes_expired_connections(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_max_inactivity", 10)
+    manager = ConnectionManager(InMemoryBroker())
+    websockets = [FakeWebSocket(), FakeWebSocket()]
+    for i, websocket in enumerate(websockets):
+        connection_id = await manager.connect(f"session_id{i}", websocket)
+        connection = manager.get_connection(f"session_id{i}", connection_id)
+        connection.last_seen -= 60
+        manager.schedule_deadline(connection)
+
+    await manager.check_stale()
+    assert all(websocket.closed for websocket in websockets)
+    assert manager.active_connections == {}
+
+
+@pytest.mark.asyncio
+async def test_check_stale_reschedules_active_connections(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_max_inactivity", 10)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    connection = manager.get_connection("session_id1", connection_id)
+    connected_at = connection.last_seen
+    connection.last_seen = connected_at + 8
+
+    assert manager.pop_expired(connected_at + 11) == []
+    assert len(manager.deadlines) == 1
+    assert manager.pop_expired(connected_at + 19) == [connection]
+
+
+@pytest.mark.asyncio
+async def test_check_stale_ignores_removed_connections(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_max_inactivity", 10)
+    manager = ConnectionManager(InMemoryBroker())
+    connection_id = await manager.connect("session_id1", FakeWebSocket())
+    last_seen = manager.get_connection("session_id1", connection_id).last_seen
+    manager.remove("session_id1", connection_id)
+
+    assert manager.pop_expired(last_seen + 11) == []
+    assert manager.deadlines == []
+
+
+@pytest.mark.asyncio
+async def test_check_stale_keeps_idle_watchers(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_max_inactivity", 10)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("watch:1", websocket, idle_timeout=False)
+    manager.get_connection("watch:1", connection_id).last_seen -= 60
+
+    await manager.check_stale()
+    assert not websocket.closed
+    assert manager.get_connection("watch:1", connection_id)
+    assert manager.deadlines == []
+
+
+@pytest.mark.asyncio
+async def test_check_stale_keeps_idle_connections_by_default():
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    manager.get_connection("session_id1", connection_id).last_seen -= 3600
+
+    await manager.check_stale()
+    assert not websocket.closed
+    assert manager.has_session("session_id1")
+
+
+# MARK: Sessions
+
+
+@pytest.mark.asyncio
+async def test_session_broadcast_reaches_every_tab():
+    manager = ConnectionManager(InMemoryBroker())
+    websockets = [FakeWebSocket(), FakeWebSocket()]
+    for websocket in websockets:
+        await manager.connect("session_id1", websocket)
+
+    await manager.send_json("session_id1", poll_payload("1", 1))
+    await manager.flush("session_id1")
+    assert all(len(websocket.sent) == 2 for websocket in websockets)
+
+
+@pytest.mark.asyncio
+async def test_reply_reaches_only_the_requesting_tab():
+    manager = ConnectionManager(InMemoryBroker())
+    first_websocket, second_websocket = FakeWebSocket(), FakeWebSocket()
+    connection_id = await manager.connect("session_id1", first_websocket)
+    await manager.connect("session_id1", second_websocket)
+
+    await manager.send_json("session_id1", poll_payload("1", 1), connection_id)
+    await manager.flush("session_id1")
+    assert len(first_websocket.sent) == 2
+    assert len(second_websocket.sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_closing_one_tab_keeps_the_others():
+    manager = ConnectionManager(InMemoryBroker())
+    first_websocket, second_websocket = FakeWebSocket(), FakeWebSocket()
+    first_connection_id = await manager.connect("session_id1", first_websocket)
+    second_connection_id = await manager.connect("session_id1", second_websocket)
+
+    await manager.disconnect("session_id1", first_connection_id)
+    assert first_websocket.closed
+    assert manager.has_session("session_id1")
+
+    manager.remove("session_id1", second_connection_id)
+    assert not manager.has_session("session_id1")
+    assert manager.active_connections == {}
+
+
+# MARK: Rooms
+
+
+@pytest.mark.asyncio
+async def test_broadcast_reaches_room_members_on_every_worker(workers):
+    first_worker, second_worker = workers
+    websockets = [FakeWebSocket(), FakeWebSocket(), FakeWebSocket()]
+    first_connection_id = await first_worker.connect("session_id1", websockets[0])
+    second_connection_id = await second_worker.connect("session_id2", websockets[1])
+    await second_worker.connect("session_id3", websockets[2])
+    first_worker.subscribe("1", "session_id1", first_connection_id)
+    second_worker.subscribe("1", "session_id2", second_connection_id)
+
+    await first_worker.broadcast("1", poll_payload("1", 1))
+    await first_worker.flush("session_id1")
+    await second_worker.flush("session_id2")
+    await second_worker.flush("session_id3")
+    assert websockets[0].sent[1:] == [{"payload": poll_payload("1", 1)}]
+    assert websockets[1].sent[1:] == [{"payload": poll_payload("1", 1)}]
+    assert websockets[2].sent[1:] == []
+
+
+@pytest.mark.asyncio
+async def test_closed_connection_leaves_its_rooms():
+    manager = ConnectionManager(InMemoryBroker())
+    connection_id = await manager.connect("session_id1", FakeWebSocket())
+    manager.subscribe("1", "session_id1", connection_id)
+    manager.subscribe("2", "session_id1", connection_id)
+    manager.unsubscribe("2", "session_id1", connection_id)
+    assert list(manager.rooms) == ["1"]
+
+    manager.remove("session_id1", connection_id)
+    assert manager.rooms == {}
+
+
+# MARK: Resume
+
+
+@pytest.mark.asyncio
+async def test_resume_replays_frames_missed_while_detached():
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket, resumable=True)
+    manager.subscribe("1", "session_id1", connection_id)
+    await manager.broadcast("1", poll_payload("1", 1))
+    await manager.flush("session_id1")
+    resume_token = websocket.sent[0]["payload"]["resume_token"]
+    assert websocket.sent[1]["seq"] == 1
+
+    await manager.release("session_id1", connection_id, websocket)
+    assert websocket.closed
+    await manager.broadcast("1", poll_payload("1", 2))
+    await manager.broadcast("1", poll_payload("1", 3))
+
+    new_websocket = FakeWebSocket()
+    connection = await manager.resume("session_id1", new_websocket, resume_token, 1)
+    assert connection.connection_id == connection_id
+    await manager.flush("session_id1")
+    assert new_websocket.sent[0]["payload"]["resumed"] is True
+    assert [frame["seq"] for frame in new_websocket.sent[1:]] == [2, 3]
+    assert new_websocket.sent[-1]["payload"] == poll_payload("1", 3)
+
+
+@pytest.mark.asyncio
+async def test_resume_refused_when_missed_frames_were_dropped(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_resume_buffer_size", 2)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket, resumable=True)
+    await manager.flush("session_id1")
+    resume_token = websocket.sent[0]["payload"]["resume_token"]
+    await manager.release("session_id1", connection_id, websocket)
+    for votes in range(3):
+        await manager.send_json("session_id1", poll_payload("1", votes))
+
+    assert await manager.resume("session_id1", FakeWebSocket(), resume_token, 0) is None
+    assert await manager.resume("session_id2", FakeWebSocket(), resume_token, 1) is None
+    assert await manager.resume("session_id1", FakeWebSocket(), resume_token, 1)
+
+
+@pytest.mark.asyncio
+async def test_resume_refused_when_replay_exceeds_send_queue(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_send_queue_size", 4)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket, resumable=True)
+    await manager.flush("session_id1")
+    resume_token = websocket.sent[0]["payload"]["resume_token"]
+    await manager.release("session_id1", connection_id, websocket)
+    for votes in range(10):
+        await manager.send_json("session_id1", poll_payload("1", votes))
+
+    assert await manager.resume("session_id1", FakeWebSocket(), resume_token, 0) is None
+    new_websocket = FakeWebSocket()
+    assert await manager.resume("session_id1", new_websocket, resume_token, 7)
+    await manager.flush("session_id1")
+    assert new_websocket.sent[0]["payload"]["resumed"] is True
+    assert [frame["seq"] for frame in new_websocket.sent[1:]] == [8, 9, 10]
+
+
+@pytest.mark.asyncio
+async def test_resume_with_empty_replay_buffer(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_resume_buffer_size", 0)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket, resumable=True)
+    await manager.flush("session_id1")
+    resume_token = websocket.sent[0]["payload"]["resume_token"]
+    await manager.release("session_id1", connection_id, websocket)
+    assert (
+        await manager.resume("session_id1", FakeWebSocket(), resume_token, -1) is None
+    )
+    await manager.send_json("session_id1", poll_payload("1", 1))
+
+    assert await manager.resume("session_id1", FakeWebSocket(), resume_token, 0) is None
+    assert await manager.resume("session_id1", FakeWebSocket(), resume_token, 1)
+
+
+@pytest.mark.asyncio
+async def test_detached_connection_expires_after_resume_window(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_resume_ttl", 10)
+    manager = ConnectionManager(InMemoryBroker())
+    closed = []
+    manager.on_session_closed(closed.append)
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket, resumable=True)
+    connection = manager.get_connection("session_id1", connection_id)
+    await manager.release("session_id1", connection_id, websocket)
+    assert manager.has_session("session_id1")
+    assert closed == []
+
+    assert manager.pop_expired(connection.detached_at + 5) == []
+    connection.detached_at -= 11
+    manager.schedule_deadline(connection)
+    await manager.check_stale()
+    assert not manager.has_session("session_id1")
+    assert manager.resumable == {}
+    assert closed == ["session_id1"]
+
+
+# MARK: Msgpack
+
+
+@pytest.mark.asyncio
+async def test_msgpack_connection_receives_binary_frames():
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket(["msgpack"])
+    json_websocket = FakeWebSocket(["other"])
+    for ws in (websocket, json_websocket):
+        connection_id = await manager.connect("session_id1", ws)
+        manager.subscribe("1", "session_id1", connection_id)
+
+    await manager.broadcast("1", poll_payload("1", 1))
+    await manager.flush("session_id1")
+    assert websocket.subprotocol == "msgpack"
+    assert json_websocket.subprotocol is None
+    assert websocket.sent == json_websocket.sent
+    assert websocket.sent[-1] == {"payload": poll_payload("1", 1)}
+
+
+# MARK: Delta
+
+
+@pytest.mark.asyncio
+async def test_delta_connection_receives_changed_votes_only():
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket, delta=True)
+    manager.subscribe("1", "session_id1", connection_id)
+
+    for votes in (1, 1, 4):
+        poll = poll_payload("1", votes)["data"]["data"]
+        await manager.broadcast_frame("1", frames.poll(PollOutputType.GET, poll))
+        await manager.flush("session_id1")
+
+    assert websocket.sent[1] == {"payload": poll_payload("1", 1)}
+    assert websocket.sent[2:] == [
+        {
+            "payload": {
+                "type": "poll",
+                "data": {
+                    "type": "delta",
+                    "data": {"poll_id": "1", "votes": {"0": 4}, "status": "ACTIVE"},
+                },
+            }
+        }
+    ]
+
+
+# MARK: Coalescer
+
+
+@pytest.mark.asyncio
+async def test_coalescer_drops_identical_snapshots_and_merges_bursts(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_coalesce_window", 0.01)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    manager.subscribe("1", "session_id1", connection_id)
+
+    for votes in (1, 2, 3, 4):
+        poll = poll_payload("1", votes)["data"]["data"]
+        await manager.broadcast_frame("1", frames.poll(PollOutputType.GET, poll))
+    await manager.flush("session_id1")
+    poll = poll_payload("1", 4)["data"]["data"]
+    await manager.broadcast_frame("1", frames.poll(PollOutputType.GET, poll))
+    await manager.flush("session_id1")
+
+    assert websocket.sent[1:] == [
+        {"payload": poll_payload("1", 1)},
+        {"payload": poll_payload("1", 4)},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalescer_keeps_topics_apart(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_coalesce_window", 0.01)
+    manager = ConnectionManager(InMemoryBroker())
+    websocket = FakeWebSocket()
+    connection_id = await manager.connect("session_id1", websocket)
+    manager.subscribe("1", "session_id1", connection_id)
+
+    for poll_id in ("1", "2"):
+        poll = poll_payload(poll_id, 1)["data"]["data"]
+        await manager.broadcast_frame("1", frames.poll(PollOutputType.GET, poll))
+    await manager.flush("session_id1")
+    assert len(websocket.sent) == 3
@@ -0,0 +1,235 @@
+import asyncio
+import json
+
+import pytest
+import respx
+from httpx import Response
+from websockets.asyncio.server import ServerConnection, serve
+
+from app.utils.config import get_settings
+from app.utils.eventsub import (
+    EventSubListener,
+    EventSubManager,
+    poll_begin,
+    poll_end,
+    poll_progress,
+)
+from app.utils.frames import Frame
+from app.utils.twitch import TwitchClient, eventsub_subscriptions, finished_polls
+
+
+def message(
+    message_type: str,
+    payload: dict,
+    message_id: str = None,
+    subscription_type: str = None,
+) -> str:
+    metadata = {
+        "message_id": message_id or message_type,
+        "message_type": message_type,
+        "message_timestamp": "2023-07-19T14:56:51.634234626Z",
+    }
+    if subscription_type:
+        metadata["subscription_type"] = subscription_type
+        metadata["subscription_version"] = "1"
+    return json.dumps({"metadata": metadata, "payload": payload})
+
+
+def welcome(session_id: str) -> str:
+    return message(
+        "session_welcome",
+        {
+            "session": {
+                "id": session_id,
+                "status": "connected",
+                "keepalive_timeout_seconds": 10,
+                "reconnect_url": None,
+            }
+        },
+    )
+
+
+def reconnect(session_id: str, reconnect_url: str) -> str:
+    return message(
+        "session_reconnect",
+        {
+            "session": {
+                "id": session_id,
+                "status": "reconnecting",
+                "keepalive_timeout_seconds": None,
+                "reconnect_url": reconnect_url,
+            }
+        },
+    )
+
+
+def poll_notification(
+    message_id: str, subscription_type: str, votes: int, status: str = None
+) -> str:
+    event = {
+        "id": "poll1",
+        "broadcaster_user_id": "1",
+        "title": "title1",
+        "choices": [
+            {"id": "choice1", "title": "choice1", "votes": votes},
+            {"id": "choice2", "title": "choice2", "votes": 0},
+        ],
+    }
+    if status:
+        event["status"] = status
+    return message(
+        "notification",
+        {"subscription": {"type": subscription_type}, "event": event},
+        message_id=message_id,
+        subscription_type=subscription_type,
+    )
+
+
+def expected_poll(votes: int, status: str = "ACTIVE") -> dict:
+    return {
+        "poll_id": "poll1",
+        "title": "title1",
+        "choices": [
+            {"title": "choice1", "votes": votes},
+            {"title": "choice2", "votes": 0},
+        ],
+        "status": status,
+    }
+
+
+class EventSubStandIn:
+    # Local stand-in for the EventSub websocket, replays a script per connection
+    def __init__(self, script: list[str]):
+        self.script = script
+
+    async def handler(self, websocket: ServerConnection):
+        for frame in self.script:
+            await websocket.send(frame)
+        await websocket.wait_closed()
+
+
+@pytest.fixture
+def subscriptions_mock():
+    with respx.mock(assert_all_called=False) as respx_mock:
+        respx_mock.post(eventsub_subscriptions, name="subscribe").mock(
+            return_value=Response(202, json={"data": []})
+        )
+        yield respx_mock
+
+
+@pytest.fixture(autouse=True)
+def setup_finished_polls():
+    finished_polls.clear()
+    yield
+    finished_polls.clear()
+
+
+async def run_until(listener: EventSubListener, done: asyncio.Event):
+    task = asyncio.create_task(listener.run())
+    try:
+        await asyncio.wait_for(done.wait(), timeout=5)
+    finally:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_eventsub_listener_forwards_poll_events(subscriptions_mock, monkeypatch):
+    stand_in = EventSubStandIn(
+        [
+            welcome("session1"),
+            message("session_keepalive", {}),
+            poll_notification("message1", poll_begin, 0),
+            poll_notification("message2", poll_progress, 1),
+            poll_notification("message2", poll_progress, 1),
+            poll_notification("message3", poll_end, 2, "completed"),
+        ]
+    )
+    received = []
+    done = asyncio.Event()
+
+    async def on_poll(user_id: str, poll: dict):
+        received.append((user_id, poll))
+        if poll["status"] != "ACTIVE":
+            done.set()
+
+    async with serve(stand_in.handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(
+            get_settings(), "twitch_eventsub_url", f"ws://127.0.0.1:{port}/ws"
+        )
+        listener = EventSubListener(TwitchClient(), "token1", "1", on_poll)
+        await run_until(listener, done)
+
+    assert received == [
+        ("1", expected_poll(0)),
+        ("1", expected_poll(1)),
+        ("1", expected_poll(2, "COMPLETED")),
+    ]
+    route = subscriptions_mock["subscribe"]
+    assert route.call_count == 3
+    subscriptions = [json.loads(call.request.content) for call in route.calls]
+    assert {subscription["type"] for subscription in subscriptions} == {
+        poll_begin,
+        poll_progress,
+        poll_end,
+    }
+    assert all(
+        subscription["transport"] == {"method": "websocket", "session_id": "session1"}
+        and subscription["condition"] == {"broadcaster_user_id": "1"}
+        for subscription in subscriptions
+    )
+    assert finished_polls.get(("1", "poll1")) == expected_poll(2, "COMPLETED")
+
+
+@pytest.mark.asyncio
+async def test_eventsub_listener_follows_reconnect(subscriptions_mock, monkeypatch):
+    second_stand_in = EventSubStandIn(
+        [
+            welcome("session1"),
+            poll_notification("message1", poll_progress, 1),
+        ]
+    )
+    received = []
+    done = asyncio.Event()
+
+    async def on_poll(user_id: str, poll: dict):
+        received.append(poll)
+        done.set()
+
+    async with serve(second_stand_in.handler, "127.0.0.1", 0) as second_server:
+        second_port = second_server.sockets[0].getsockname()[1]
+        first_stand_in = EventSubStandIn(
+            [
+                welcome("session1"),
+                reconnect("session1", f"ws://127.0.0.1:{second_port}/ws"),
+            ]
+        )
+        async with serve(first_stand_in.handler, "127.0.0.1", 0) as first_server:
+            first_port = first_server.sockets[0].getsockname()[1]
+            monkeypatch.setattr(
+                get_settings(),
+                "twitch_eventsub_url",
+                f"ws://127.0.0.1:{first_port}/ws",
+            )
+            listener = EventSubListener(TwitchClient(), "token1", "1", on_poll)
+            await run_until(listener, done)
+
+    assert received == [expected_poll(1)]
+    assert subscriptions_mock["subscribe"].call_count == 3
+
+
+class FakeConnectionManager:
+    def __init__(self):
+        self.sent: list[tuple[str, dict]] = []
+
+    async def broadcast_frame(self, room: str, frame: Frame):
+        self.sent.append((room, json.loads(frame.text)["payload"]))
+
+
+@pytest.mark.asyncio
+async def test_eventsub_manager_broadcasts_to_broadcaster_room():
+    manager = EventSubManager(FakeConnectionManager())
+    manager.sessions["1"] = {"session_id1", "session_id2"}
+    manager.sessions["2"] = {"session_id3"}
+    await manager.on_poll("1", expected_poll(1))
+    assert [room for room, _ in manager.connection_manager.sent] == ["1"]
@@ -0,0 +1,108 @@
+import httpx
+import pytest
+
+from app.tests.fixtures.fake_twitch import FakeTwitchSettings, create_fake_twitch_app
+from app.utils.config import get_settings
+from app.utils.errors import BaseError
+from app.utils.twitch import TwitchClient, finished_polls, recent_polls, twitch_breaker
+
+
+def fake_twitch_client(**settings) -> TwitchClient:
+    fake_app = create_fake_twitch_app(FakeTwitchSettings(**settings))
+    twitch_client = TwitchClient()
+    twitch_client.client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=fake_app)
+    )
+    return twitch_client
+
+
+@pytest.fixture(autouse=True)
+def setup_twitch_state(monkeypatch):
+    monkeypatch.setattr(get_settings(), "twitch_backoff", 0)
+    twitch_breaker.reset()
+    recent_polls.clear()
+    finished_polls.clear()
+    yield
+    twitch_breaker.reset()
+    recent_polls.clear()
+    finished_polls.clear()
+
+
+@pytest.mark.asyncio
+async def test_fake_twitch_login_and_poll_flow():
+    twitch_client = fake_twitch_client()
+    user_id, login, token, refresh_token = await twitch_client.callback("42")
+    assert (user_id, login) == ("42", "user42")
+
+    username, email = await twitch_client.get_user(token, user_id)
+    assert (username, email) == ("User42", "user42@example.com")
+    assert await twitch_client.is_token_valid(token, user_id)
+    assert not await twitch_client.is_token_valid("wrong", user_id)
+
+    poll = await twitch_client.create_poll(
+        token=token, user_id=user_id, title="poll", choices=["a", "b"]
+    )
+    output = await twitch_client.get_poll(
+        token=token, user_id=user_id, poll_id=poll["poll_id"]
+    )
+    assert output["status"] == "ACTIVE"
+    assert [choice["title"] for choice in output["choices"]] == ["a", "b"]
+
+    output = await twitch_client.end_poll(
+        token=token, user_id=user_id, poll_id=poll["poll_id"]
+    )
+    assert output["status"] == "TERMINATED"
+
+
+@pytest.mark.asyncio
+async def test_fake_twitch_polls_require_json():
+    twitch_client = fake_twitch_client()
+    headers = {"Authorization": "Bearer token-1", "Client-Id": "fake"}
+    url = "https://api.twitch.tv/helix/polls"
+    body = {"broadcaster_id": "1", "title": "poll", "choices": [{"title": "a"}]}
+    response = await twitch_client.client.post(url, headers=headers, data=body)
+    assert response.status_code == 400
+    response = await twitch_client.client.post(url, headers=headers, json=body)
+    assert response.status_code == 200
+    response = await twitch_client.client.patch(
+        url,
+        headers=headers,
+        data={"broadcaster_id": "1", "id": "poll1", "status": "TERMINATED"},
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_fake_twitch_sends_rate_limit_headers():
+    twitch_client = fake_twitch_client(rate_limit=2)
+    headers = {"Authorization": "Bearer token-1", "Client-Id": "fake"}
+    url = "https://api.twitch.tv/helix/users"
+    first = await twitch_client.client.get(url, headers=headers)
+    second = await twitch_client.client.get(url, headers=headers)
+    third = await twitch_client.client.get(url, headers=headers)
+    assert first.headers["Ratelimit-Limit"] == "2"
+    assert first.headers["Ratelimit-Remaining"] == "1"
+    assert second.status_code == 200
+    assert third.status_code == 429
+    assert int(third.headers["Ratelimit-Reset"]) > 0
+
+
+@pytest.mark.asyncio
+async def test_fake_twitch_error_rate():
+    twitch_client = fake_twitch_client(error_rate=1)
+    with pytest.raises(BaseError):
+        await twitch_client.create_poll(
+            token="token-1", user_id="1", title="poll", choices=["a", "b"]
+        )
+    with pytest.raises(BaseError):
+        await twitch_client.get_user("token-1", "1")
+    # One failure per call, whatever the number of retries
+    assert twitch_breaker.failures == 2
+
+
+@pytest.mark.asyncio
+async def test_fake_twitch_creates_eventsub_subscriptions():
+    twitch_client = fake_twitch_client()
+    await twitch_client.create_eventsub_subscription(
+        "token-1", "1", "session1", "channel.poll.begin"
+    )
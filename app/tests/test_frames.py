@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from app.schemas.websocket import ConnectionStatus, PollOutputType, WebSocketOutput
+from app.utils import frames
+from app.utils.config import get_settings
+from app.utils.errors import BaseError, PollNotFoundError, UnknownTypeFieldError
+
+
+def make_poll(votes: int, status: str = "ACTIVE") -> dict:
+    return {
+        "poll_id": "poll1",
+        "title": "title1",
+        "choices": [{"title": "choice1", "votes": votes}],
+        "status": status,
+    }
+
+
+def test_frames_match_validated_output():
+    for frame in (
+        frames.connection_status(ConnectionStatus.CONNECTED),
+        frames.error(PollNotFoundError()),
+        frames.poll(PollOutputType.GET, make_poll(1)),
+        frames.poll_delta("poll1", (1, 2), (1, 3), "ACTIVE"),
+    ):
+        data = json.loads(frame.text)
+        output = WebSocketOutput.model_validate(data)
+        assert output.model_dump(mode="json", exclude_none=True) == data
+
+
+def test_constant_frames_are_cached():
+    assert frames.connection_status(
+        ConnectionStatus.CONNECTED
+    ) is frames.connection_status(ConnectionStatus.CONNECTED)
+    assert frames.error(UnknownTypeFieldError()) is frames.error(
+        UnknownTypeFieldError()
+    )
+    assert frames.error(BaseError("first")) != frames.error(BaseError("second"))
+
+
+def test_only_poll_snapshots_are_coalesced():
+    assert frames.poll(PollOutputType.GET, make_poll(1)).key == "poll:poll1"
+    assert frames.poll(PollOutputType.END, make_poll(1, "COMPLETED")).key is None
+
+
+def test_encode_validates_in_debug_mode(monkeypatch):
+    payload = {"type": "connection_status", "status": "unknown"}
+    monkeypatch.setattr(get_settings(), "websocket_validate_output", False)
+    frames.encode(payload)
+
+    monkeypatch.setattr(get_settings(), "websocket_validate_output", True)
+    with pytest.raises(ValueError):
+        frames.encode(payload)
+
+
+def test_reply_appends_request_id_to_cached_frame():
+    frame = frames.error(PollNotFoundError())
+    assert frames.reply(frame, None) is frame
+    assert json.loads(frames.reply(frame, 'id"1').text) == {
+        "payload": PollNotFoundError().json(),
+        "request_id": 'id"1',
+    }
+    assert frames.error(PollNotFoundError()) is frame
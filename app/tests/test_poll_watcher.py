@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import pytest
+
+from app.utils.config import get_settings
+from app.utils.errors import TwitchUnavailableError
+from app.utils.frames import Frame
+from app.utils.poll_watcher import PollWatcher
+
+
+class FakeConnectionManager:
+    def __init__(self):
+        self.sent: list[tuple[str, dict]] = []
+
+    async def broadcast_frame(self, room: str, frame: Frame):
+        self.sent.append((room, json.loads(frame.text)["payload"]))
+
+
+class ScriptedTwitchClient:
+    def __init__(self, polls: list):
+        self.polls = polls
+        self.calls = 0
+
+    async def get_poll(self, token: str, user_id: str, poll_id: str) -> dict:
+        poll = self.polls[min(self.calls, len(self.polls) - 1)]
+        self.calls += 1
+        if isinstance(poll, Exception):
+            raise poll
+        return poll
+
+
+def make_poll(votes: int, status: str = "ACTIVE") -> dict:
+    return {
+        "poll_id": "poll1",
+        "title": "title1",
+        "choices": [
+            {"title": "choice1", "votes": votes},
+            {"title": "choice2", "votes": 0},
+        ],
+        "status": status,
+    }
+
+
+@pytest.fixture(autouse=True)
+def setup_intervals(monkeypatch):
+    monkeypatch.setattr(get_settings(), "poll_watch_min_interval", 0.001)
+    monkeypatch.setattr(get_settings(), "poll_watch_max_interval", 0.004)
+    monkeypatch.setattr(get_settings(), "poll_watch_grace", 0)
+
+
+@pytest.mark.asyncio
+async def test_poll_watcher_pushes_changes_until_poll_ends():
+    manager = FakeConnectionManager()
+    twitch_client = ScriptedTwitchClient(
+        [
+            make_poll(1),
+            make_poll(1),
+            TwitchUnavailableError(),
+            make_poll(2),
+            make_poll(3, "COMPLETED"),
+        ]
+    )
+    watcher = PollWatcher(manager)
+    await watcher.watch("session_id1", twitch_client, "token1", "1", "poll1", 60)
+    assert [payload["data"]["data"] for _, payload in manager.sent] == [
+        make_poll(1),
+        make_poll(2),
+        make_poll(3, "COMPLETED"),
+    ]
+    assert twitch_client.calls == 5
+
+
+@pytest.mark.asyncio
+async def test_poll_watcher_stops_when_duration_elapses():
+    manager = FakeConnectionManager()
+    twitch_client = ScriptedTwitchClient([make_poll(1)])
+    watcher = PollWatcher(manager)
+    await asyncio.wait_for(
+        watcher.watch("session_id1", twitch_client, "token1", "1", "poll1", 0.05),
+        timeout=1,
+    )
+    assert len(manager.sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_poll_watcher_start_replaces_and_stop_cancels():
+    manager = FakeConnectionManager()
+    twitch_client = ScriptedTwitchClient([make_poll(1)])
+    watcher = PollWatcher(manager)
+    watcher.start("session_id1", twitch_client, "token1", "1", "poll1", 60)
+    first = watcher.watches["session_id1"]
+    watcher.start("session_id1", twitch_client, "token1", "1", "poll2", 60)
+    await asyncio.sleep(0)
+    assert first.cancelled()
+    watcher.stop("session_id1")
+    await asyncio.sleep(0)
+    assert watcher.watches == {}
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from app.utils.task_queue import TaskQueue
+
+
+@pytest.mark.asyncio
+async def test_task_queue_runs_jobs():
+    done = []
+
+    async def job(value: int):
+        done.append(value)
+
+    task_queue = TaskQueue(workers=2, maxsize=10, retries=0, backoff=0)
+    task_queue.start()
+    for value in range(5):
+        assert task_queue.enqueue(job, value)
+    await task_queue.stop(timeout=1)
+    assert sorted(done) == [0, 1, 2, 3, 4]
+    assert task_queue.workers == []
+
+
+@pytest.mark.asyncio
+async def test_task_queue_retries_failing_jobs():
+    attempts = []
+
+    async def flaky_job():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("flaky")
+
+    task_queue = TaskQueue(workers=1, maxsize=10, retries=2, backoff=0)
+    task_queue.start()
+    task_queue.enqueue(flaky_job)
+    await task_queue.stop(timeout=1)
+    assert len(attempts) == 3
+
+
+@pytest.mark.asyncio
+async def test_task_queue_gives_up_after_retries():
+    attempts = []
+
+    async def failing_job():
+        attempts.append(1)
+        raise RuntimeError("failing")
+
+    task_queue = TaskQueue(workers=1, maxsize=10, retries=1, backoff=0)
+    task_queue.start()
+    task_queue.enqueue(failing_job)
+    await task_queue.stop(timeout=1)
+    assert len(attempts) == 2
+
+
+@pytest.mark.asyncio
+async def test_task_queue_drops_jobs_when_full():
+    async def job():
+        await asyncio.sleep(0)
+
+    task_queue = TaskQueue(workers=1, maxsize=1, retries=0, backoff=0)
+    assert task_queue.enqueue(job)
+    assert not task_queue.enqueue(job)
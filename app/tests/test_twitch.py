@@ -1,9 +1,21 @@
+import asyncio
+import json
+import time
+
+import httpx
 import pytest
 import respx
 from httpx import Response
 
 from app.utils.config import get_settings
-from app.utils.twitch import TwitchClient
+from app.utils.errors import BaseError, TwitchUnavailableError
+from app.utils.twitch import (
+    TwitchClient,
+    finished_polls,
+    poll_flights,
+    recent_polls,
+    twitch_breaker,
+)
 
 
 @pytest.fixture
@@ -228,11 +240,38 @@ def twitch_client():
     return TwitchClient()
 
 
+@pytest.fixture(autouse=True)
+def setup_twitch_state(monkeypatch):
+    monkeypatch.setattr(get_settings(), "twitch_backoff", 0)
+    twitch_breaker.reset()
+    recent_polls.clear()
+    finished_polls.clear()
+    yield
+    twitch_breaker.reset()
+    recent_polls.clear()
+    finished_polls.clear()
+
+
+poll_response = {
+    "data": [
+        {
+            "id": "poll1",
+            "title": "title",
+            "choices": [
+                {"id": "choice1", "title": "choice1", "votes": 1},
+                {"id": "choice2", "title": "choice2", "votes": 2},
+            ],
+            "status": "ACTIVE",
+        }
+    ]
+}
+
+
 # MARK: Request
 
 
 @pytest.mark.asyncio
-async def test_callback_request_ok(twitch_id_mock, twitch_client):
+async def test_callback_request_ok(twitch_id_mock, twitch_api_mock, twitch_client):
     await twitch_client.callback("code")
 
     assert twitch_id_mock["token"].called
@@ -251,6 +290,8 @@ async def test_callback_request_ok(twitch_id_mock, twitch_client):
     url = str(route.calls.last.request.url)
     assert "https://id.twitch.tv/oauth2/validate" in url
 
+    assert not twitch_api_mock["get_user"].called
+
 
 @pytest.mark.asyncio
 async def test_is_valid_token_request_ok(twitch_api_mock, twitch_client):
@@ -283,14 +324,14 @@ async def test_create_poll_request_ok(twitch_api_mock, twitch_client):
     route = twitch_api_mock["create_poll"]
     url = str(route.calls.last.request.url)
     assert "https://api.twitch.tv/helix/polls" in url
-    data = str(route.calls.last.request.content)
-    assert "broadcaster_id=user1" in data
-    assert "title=poll" in data
-    assert (
-        "choices=%7B%27title%27%3A+%27choice1%27%7D&choices=%7B%27title%27%3A+%27choice2%27%7D"
-        in data
-    )
-    assert "duration=60" in data
+    request = route.calls.last.request
+    assert request.headers["Content-Type"] == "application/json"
+    assert json.loads(request.content) == {
+        "broadcaster_id": "user1",
+        "title": "poll",
+        "choices": [{"title": "choice1"}, {"title": "choice2"}],
+        "duration": 60,
+    }
 
 
 @pytest.mark.asyncio
@@ -315,10 +356,13 @@ async def test_end_poll_request_ok(twitch_api_mock, twitch_client):
     route = twitch_api_mock["end_poll"]
     url = str(route.calls.last.request.url)
     assert "https://api.twitch.tv/helix/polls" in url
-    data = str(route.calls.last.request.content)
-    assert "broadcaster_id=user1" in data
-    assert "id=poll1" in data
-    assert "status=TERMINATED" in data
+    request = route.calls.last.request
+    assert request.headers["Content-Type"] == "application/json"
+    assert json.loads(request.content) == {
+        "broadcaster_id": "user1",
+        "id": "poll1",
+        "status": "TERMINATED",
+    }
 
 
 # MARK: Output
@@ -336,8 +380,9 @@ async def test_get_authorization_url_ok(twitch_client):
 
 @pytest.mark.asyncio
 async def test_callback_output_ok(twitch_id_mock, twitch_client):
-    user_id, token, refresh_token = await twitch_client.callback("fake_code")
+    user_id, login, token, refresh_token = await twitch_client.callback("fake_code")
     assert user_id == "user1"
+    assert login == "user1"
     assert token == "token1"
     assert refresh_token == "refresh_token1"
 
@@ -394,3 +439,209 @@ async def test_end_poll_output_ok(twitch_api_mock, twitch_client):
         "choices": [{"title": "choice1", "votes": 1}, {"title": "choice2", "votes": 2}],
         "status": "TERMINATED",
     }
+
+
+# MARK: Coalescing
+
+
+@pytest.mark.asyncio
+async def test_concurrent_get_poll_share_one_request(twitch_client):
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(
+            return_value=Response(200, json=poll_response)
+        )
+        outputs = await asyncio.gather(
+            *[
+                twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+                for _ in range(5)
+            ]
+        )
+    assert route.call_count == 1
+    assert all(output == outputs[0] for output in outputs)
+    assert not poll_flights.in_flight
+
+
+@pytest.mark.asyncio
+async def test_get_poll_uses_recent_result(twitch_client):
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(
+            return_value=Response(200, json=poll_response)
+        )
+        await twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+        await twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+        await twitch_client.get_poll(token="token1", user_id="user2", poll_id="poll1")
+    assert route.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_finished_poll_is_cached(twitch_client, monkeypatch):
+    monkeypatch.setattr(recent_polls, "ttl", 0)
+    finished_response = {"data": [{**poll_response["data"][0], "status": "COMPLETED"}]}
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(
+            return_value=Response(200, json=finished_response)
+        )
+        first = await twitch_client.get_poll(
+            token="token1", user_id="user1", poll_id="poll1"
+        )
+        second = await twitch_client.get_poll(
+            token="token1", user_id="user1", poll_id="poll1"
+        )
+    assert route.call_count == 1
+    assert first == second
+    assert first["status"] == "COMPLETED"
+
+
+@pytest.mark.asyncio
+async def test_active_poll_is_not_cached_once_expired(twitch_client, monkeypatch):
+    monkeypatch.setattr(recent_polls, "ttl", 0)
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(
+            return_value=Response(200, json=poll_response)
+        )
+        await twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+        await twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+    assert route.call_count == 2
+    assert len(finished_polls) == 0
+
+
+@pytest.mark.asyncio
+async def test_ended_poll_is_served_from_cache(twitch_api_mock, twitch_client):
+    ended = await twitch_client.end_poll(
+        token="token1", user_id="user1", poll_id="poll1"
+    )
+    assert (
+        await twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+        == ended
+    )
+    assert (
+        await twitch_client.end_poll(token="token1", user_id="user1", poll_id="poll1")
+        == ended
+    )
+    assert twitch_api_mock["end_poll"].call_count == 1
+    assert not twitch_api_mock["get_poll"].called
+
+
+# MARK: Resilience
+
+
+@pytest.mark.asyncio
+async def test_get_poll_retries_server_errors(twitch_client):
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(
+            side_effect=[Response(503), Response(200, json=poll_response)]
+        )
+        output = await twitch_client.get_poll(
+            token="token1", user_id="user1", poll_id="poll1"
+        )
+    assert route.call_count == 2
+    assert output["poll_id"] == "poll1"
+
+
+@pytest.mark.asyncio
+async def test_get_poll_retries_timeouts_then_raises_TwitchUnavailableError(
+    twitch_client,
+):
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(
+            side_effect=httpx.ConnectTimeout("timeout")
+        )
+        with pytest.raises(TwitchUnavailableError):
+            await twitch_client.get_poll(
+                token="token1", user_id="user1", poll_id="poll1"
+            )
+    assert route.call_count == 1 + get_settings().twitch_retries
+
+
+@pytest.mark.asyncio
+async def test_retried_call_counts_as_one_breaker_failure(twitch_client):
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(return_value=Response(503))
+        with pytest.raises(BaseError):
+            await twitch_client.get_poll(
+                token="token1", user_id="user1", poll_id="poll1"
+            )
+    assert route.call_count == 1 + get_settings().twitch_retries
+    assert twitch_breaker.failures == 1
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_call_waits_for_reset(twitch_client, monkeypatch):
+    delays = []
+
+    async def sleep(delay: float):
+        delays.append(delay)
+
+    monkeypatch.setattr("app.utils.twitch.asyncio.sleep", sleep)
+    reset = str(int(time.time()) + 2)
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/polls").mock(
+            side_effect=[
+                Response(429, headers={"Ratelimit-Reset": reset}),
+                Response(429, headers={"Retry-After": "0.5"}),
+                Response(200, json=poll_response),
+            ]
+        )
+        await twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+    assert route.call_count == 3
+    assert 0 < delays[0] <= 2
+    assert delays[1] == 0.5
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_call_returns_when_reset_is_too_far(twitch_client):
+    reset = str(int(time.time()) + 60)
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.get("/helix/users").mock(
+            return_value=Response(429, headers={"Ratelimit-Reset": reset})
+        )
+        assert not await twitch_client.is_token_valid("token1", "user1")
+    assert route.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_create_poll_is_not_retried(twitch_client):
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.post("/helix/polls").mock(return_value=Response(500))
+        with pytest.raises(BaseError):
+            await twitch_client.create_poll(
+                token="token1",
+                user_id="user1",
+                title="poll",
+                choices=["choice1", "choice2"],
+            )
+    assert route.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast_when_open(twitch_client):
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        route = respx_mock.post("/helix/polls").mock(return_value=Response(500))
+        for _ in range(get_settings().twitch_breaker_threshold):
+            with pytest.raises(BaseError):
+                await twitch_client.create_poll(
+                    token="token1",
+                    user_id="user1",
+                    title="poll",
+                    choices=["choice1", "choice2"],
+                )
+        assert twitch_breaker.is_open
+        with pytest.raises(TwitchUnavailableError):
+            await twitch_client.create_poll(
+                token="token1",
+                user_id="user1",
+                title="poll",
+                choices=["choice1", "choice2"],
+            )
+    assert route.call_count == get_settings().twitch_breaker_threshold
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_closes_after_successful_trial(twitch_client):
+    twitch_breaker.opened_at = 0
+    with respx.mock(base_url="https://api.twitch.tv") as respx_mock:
+        respx_mock.get("/helix/polls").mock(
+            return_value=Response(200, json=poll_response)
+        )
+        await twitch_client.get_poll(token="token1", user_id="user1", poll_id="poll1")
+    assert not twitch_breaker.is_open
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Generator
 
 import pytest
@@ -11,6 +12,7 @@ from app.tests.fixtures.fixtures_artifact import (
     fake_session_id,
     fake_state,
     override_get_postgres_manager,
+    override_get_postgres_session_factory,
     override_get_session_id,
     override_get_state,
     override_get_twitch_client,
@@ -19,21 +21,29 @@ from app.tests.fixtures.fixtures_classes import FixtureUsers
 from app.utils.config import get_settings
 from app.utils.dependencies import (
     get_postgres_database,
+    get_postgres_session_factory,
     get_session_id,
     get_state,
+    get_task_queue,
     get_twitch_client,
 )
 from app.utils.errors import (
     NoSessionError,
+    NotLoggedInError,
     PotentialCSRFError,
     TwitchCallbackError,
     TwitchStatesError,
 )
+from app.utils.jobs import refresh_user_profile
+from app.utils.task_queue import TaskQueue
 
 app.dependency_overrides[get_postgres_database] = override_get_postgres_manager
 app.dependency_overrides[get_state] = override_get_state
 app.dependency_overrides[get_session_id] = override_get_session_id
 app.dependency_overrides[get_twitch_client] = override_get_twitch_client
+app.dependency_overrides[get_postgres_session_factory] = (
+    override_get_postgres_session_factory
+)
 
 client = TestClient(app)
 
@@ -125,6 +135,29 @@ def test_is_logged_in_expired_token_returns_false(setup_users, setup_cookies):
     assert response.json() == {"is_logged_in": False}
 
 
+# MARK: /users/me
+
+
+def test_me_no_cookies_returns_NotLoggedInError(setup_users, setup_cookies):
+    response = client.get("/users/me")
+    assert response.status_code == 401
+    assert response.json()["error_code"] == NotLoggedInError().error_code
+
+
+def test_me_ok(setup_users, setup_cookies):
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    response = client.get("/users/me")
+    assert response.status_code == 200
+    assert response.json() == setup_users.user1.model_dump()
+
+
+def test_me_expired_token_returns_NotLoggedInError(setup_users, setup_cookies):
+    client.cookies.set("session_id", setup_users.user2.session_id)
+    response = client.get("/users/me")
+    assert response.status_code == 401
+    assert response.json()["error_code"] == NotLoggedInError().error_code
+
+
 # MARK: /users/login
 
 
@@ -191,6 +224,30 @@ def test_callback_multiple_ok(
     assert client.cookies.get("session_id") == fake_session_id
 
 
+def test_callback_defers_profile_refresh(setup_users, setup_cookies):
+    task_queue = TaskQueue(workers=1, maxsize=10, retries=0, backoff=0)
+    app.dependency_overrides[get_task_queue] = lambda: task_queue
+    try:
+        client.cookies.set("state", fake_state)
+        client.get(f"/users/callback?state={fake_state}&code=code")
+    finally:
+        del app.dependency_overrides[get_task_queue]
+
+    postgres_database = TestingSessionLocal()
+    user = postgres_database.query(UserBase).filter(UserBase.user_id == "3").one()
+    assert user.session_id == fake_session_id
+    assert user.email == ""
+
+    func, args, kwargs = task_queue.queue.get_nowait()
+    assert func is refresh_user_profile
+    asyncio.run(func(*args, **kwargs))
+
+    postgres_database.refresh(user)
+    assert user.username == "3"
+    assert user.email == "user3@test.com"
+    postgres_database.close()
+
+
 # MARK: /users/logout
 
 
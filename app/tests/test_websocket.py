@@ -1,5 +1,7 @@
+import asyncio
 from typing import Generator
 
+import msgpack
 import pytest
 from fastapi.testclient import TestClient
 from starlette.testclient import WebSocketDenialResponse
@@ -8,28 +10,49 @@ from app.main import app
 from app.models.users import UserBase
 from app.schemas.users import User
 from app.tests.fixtures.fixtures_artifact import (
+    FakeTwitchClient,
     TestingSessionLocal,
     override_get_postgres_manager,
+    override_get_postgres_session_factory,
     override_get_twitch_client,
 )
 from app.tests.fixtures.fixtures_classes import FixtureUsers
-from app.utils.dependencies import get_postgres_database, get_twitch_client
+from app.utils.concurrency import poll_starts
+from app.utils.config import get_settings
+from app.utils.connection_manager import connection_manager
+from app.utils.dependencies import (
+    get_postgres_database,
+    get_postgres_session_factory,
+    get_twitch_client,
+)
 from app.utils.errors import (
+    BaseError,
+    FrameTooLargeError,
     IncorrectPayloadError,
     IncorrectWebsocketInputError,
     MissingPayloadError,
     MissingTypeFieldError,
     PollNotFoundError,
+    TooManyMessagesError,
     UnknownTypeFieldError,
 )
+from app.utils.poll_watcher import poll_watcher
 
 app.dependency_overrides[get_postgres_database] = override_get_postgres_manager
 app.dependency_overrides[get_twitch_client] = override_get_twitch_client
+app.dependency_overrides[get_postgres_session_factory] = (
+    override_get_postgres_session_factory
+)
 
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def setup_output_validation(monkeypatch):
+    monkeypatch.setattr(get_settings(), "websocket_validate_output", True)
+
+
 @pytest.fixture
 def users() -> list[UserBase]:
     # Logged in user, working token
@@ -134,6 +157,15 @@ def test_bad_websocket_input_returns_IncorrectWebsocketOutputError(websocket_con
     assert payload == IncorrectWebsocketInputError().json()
 
 
+def test_websocket_invalid_json_returns_IncorrectWebsocketInputError(
+    websocket_connect,
+):
+    websocket = websocket_connect
+    websocket.send_text("not json")
+    data = websocket.receive_json()
+    assert data["payload"] == IncorrectWebsocketInputError().json()
+
+
 def test_websocket_json_missing_payload_returns_MissingPayloadError(websocket_connect):
     websocket = websocket_connect
     websocket.send_json({"not_a_payload": "anything"})
@@ -152,6 +184,14 @@ def test_websocket_json_missing_type_returns_MissingTypeFieldError(websocket_con
     assert payload == MissingTypeFieldError().json()
 
 
+def test_websocket_json_null_type_returns_MissingTypeFieldError(websocket_connect):
+    websocket = websocket_connect
+    for payload_type in (None, ""):
+        websocket.send_json({"payload": {"type": payload_type}})
+        data = websocket.receive_json()
+        assert data["payload"] == MissingTypeFieldError().json()
+
+
 def test_websocket_json_missing_type_returns_UnknownTypeFieldError(websocket_connect):
     websocket = websocket_connect
     websocket.send_json({"payload": {"type": "unknown_type"}})
@@ -410,6 +450,192 @@ def test_websocket_create_poll_ok(websocket_connect):
     }
 
 
+def test_websocket_create_poll_pushes_progress(websocket_connect, monkeypatch):
+    monkeypatch.setattr(get_settings(), "poll_watch_min_interval", 0.01)
+    websocket = websocket_connect
+    websocket.send_json(
+        {
+            "payload": {
+                "type": "poll",
+                "data": {
+                    "type": "start",
+                    "data": {
+                        "title": "poll 1",
+                        "choices": ["choice1", "choice2"],
+                    },
+                },
+            }
+        }
+    )
+    data = websocket.receive_json()
+    assert data["payload"]["data"]["type"] == "start"
+    data = websocket.receive_json()
+    assert data == {
+        "payload": {
+            "type": "poll",
+            "data": {
+                "type": "get",
+                "data": {
+                    "poll_id": "poll1",
+                    "title": "title1",
+                    "choices": [
+                        {"title": "choice1", "votes": 1},
+                        {"title": "choice2", "votes": 2},
+                    ],
+                    "status": "ACTIVE",
+                },
+            },
+        }
+    }
+
+
+def test_websocket_create_poll_same_idempotency_key_creates_once(
+    websocket_connect, monkeypatch
+):
+    poll_starts.clear()
+    calls = []
+
+    async def create_poll(**kwargs) -> dict:
+        calls.append(kwargs)
+        return {"poll_id": f"poll{len(calls)}"}
+
+    monkeypatch.setattr(FakeTwitchClient, "create_poll", create_poll)
+    watched = []
+    monkeypatch.setattr(
+        poll_watcher, "start", lambda *args, **kwargs: watched.append(kwargs)
+    )
+    broadcasts = []
+    broadcast_frame = connection_manager.broadcast_frame
+
+    async def count_broadcasts(room, frame, exclude=None):
+        broadcasts.append(frame)
+        await broadcast_frame(room, frame, exclude)
+
+    monkeypatch.setattr(connection_manager, "broadcast_frame", count_broadcasts)
+    websocket = websocket_connect
+    for _ in range(2):
+        websocket.send_json(
+            {
+                "payload": {
+                    "type": "poll",
+                    "data": {
+                        "type": "start",
+                        "data": {
+                            "title": "poll 1",
+                            "choices": ["choice1", "choice2"],
+                            "idempotency_key": "key1",
+                        },
+                    },
+                }
+            }
+        )
+        data = websocket.receive_json()
+        assert data["payload"]["data"]["data"] == {"poll_id": "poll1"}
+    assert len(calls) == 1
+    assert len(watched) == 1
+    assert len(broadcasts) == 1
+    poll_starts.clear()
+
+
+def test_websocket_create_poll_twitch_error_returns_error_frame(
+    websocket_connect, monkeypatch
+):
+    async def create_poll(**kwargs) -> dict:
+        raise BaseError("twitch create poll error")
+
+    monkeypatch.setattr(FakeTwitchClient, "create_poll", create_poll)
+    websocket = websocket_connect
+    websocket.send_json(
+        {
+            "request_id": "request1",
+            "payload": {
+                "type": "poll",
+                "data": {
+                    "type": "start",
+                    "data": {"title": "poll 1", "choices": ["choice1", "choice2"]},
+                },
+            },
+        }
+    )
+    data = websocket.receive_json()
+    assert data["payload"] == BaseError("twitch create poll error").json()
+    assert data["request_id"] == "request1"
+
+
+def test_websocket_get_poll_unexpected_error_returns_BaseError(
+    websocket_connect, monkeypatch
+):
+    async def get_poll(**kwargs) -> dict:
+        return [][0]
+
+    monkeypatch.setattr(FakeTwitchClient, "get_poll", get_poll)
+    websocket = websocket_connect
+    websocket.send_json(
+        {
+            "request_id": "request1",
+            "payload": {
+                "type": "poll",
+                "data": {"type": "get", "data": {"poll_id": "poll1"}},
+            },
+        }
+    )
+    data = websocket.receive_json()
+    assert data["payload"] == BaseError("Unexpected error").json()
+    assert data["request_id"] == "request1"
+
+
+def test_websocket_slow_start_does_not_block_get(websocket_connect, monkeypatch):
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def create_poll(**kwargs) -> dict:
+        started.set()
+        await release.wait()
+        return {"poll_id": "poll1"}
+
+    async def get_poll(**kwargs) -> dict:
+        # Only answers while the start is still pending
+        await started.wait()
+        release.set()
+        return {
+            "poll_id": "poll1",
+            "title": "title1",
+            "choices": [{"title": "choice1", "votes": 1}],
+            "status": "ACTIVE",
+        }
+
+    monkeypatch.setattr(FakeTwitchClient, "create_poll", create_poll)
+    monkeypatch.setattr(FakeTwitchClient, "get_poll", get_poll)
+    websocket = websocket_connect
+    websocket.send_json(
+        {
+            "payload": {
+                "type": "poll",
+                "data": {
+                    "type": "start",
+                    "data": {"title": "poll 1", "choices": ["choice1", "choice2"]},
+                },
+            },
+            "request_id": "start1",
+        }
+    )
+    websocket.send_json(
+        {
+            "payload": {
+                "type": "poll",
+                "data": {"type": "get", "data": {"poll_id": "poll1"}},
+            },
+            "request_id": "get1",
+        }
+    )
+    first = websocket.receive_json()
+    second = websocket.receive_json()
+    assert first["request_id"] == "get1"
+    assert first["payload"]["data"]["type"] == "get"
+    assert second["request_id"] == "start1"
+    assert second["payload"]["data"] == {"type": "start", "data": {"poll_id": "poll1"}}
+
+
 # MARK: Get
 
 
@@ -606,3 +832,232 @@ def test_websocket_end_poll_ok(websocket_connect):
             },
         }
     }
+
+
+# MARK: -Liveness
+
+
+def test_websocket_message_updates_activity(websocket_connect):
+    websocket = websocket_connect
+    (connection,) = connection_manager.connections("session_id1")
+    connection.last_seen = 0
+    websocket.send_json({"payload": {"type": "unknown_type"}})
+    websocket.receive_json()
+    assert connection.last_seen > 0
+
+
+def test_websocket_client_drop_releases_connection(setup_users, setup_cookies):
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect("/websocket/connect") as websocket:
+        websocket.receive_json()
+        assert "session_id1" in connection_manager.active_connections
+    assert "session_id1" not in connection_manager.active_connections
+
+
+def test_websocket_second_tab_keeps_first_tab(setup_users, setup_cookies):
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect("/websocket/connect") as first_tab:
+        first_tab.receive_json()
+        with client.websocket_connect("/websocket/connect") as second_tab:
+            second_tab.receive_json()
+            assert len(connection_manager.connections("session_id1")) == 2
+        first_tab.send_json({"payload": {"type": "unknown_type"}})
+        assert first_tab.receive_json()["payload"] == UnknownTypeFieldError().json()
+        assert len(connection_manager.connections("session_id1")) == 1
+    assert not connection_manager.has_session("session_id1")
+
+
+# MARK: -Limits
+
+
+def test_websocket_frame_too_large_returns_FrameTooLargeError(websocket_connect):
+    websocket = websocket_connect
+    websocket.send_text("x" * (get_settings().websocket_max_frame_size + 1))
+    assert websocket.receive_json()["payload"] == FrameTooLargeError().json()
+    websocket.send_json({"payload": {"type": "unknown_type"}})
+    assert websocket.receive_json()["payload"] == UnknownTypeFieldError().json()
+
+
+def test_websocket_frame_size_counts_bytes(websocket_connect):
+    websocket = websocket_connect
+    # Fits in characters, not in UTF-8 bytes
+    websocket.send_text("é" * get_settings().websocket_max_frame_size)
+    assert websocket.receive_json()["payload"] == FrameTooLargeError().json()
+
+
+def test_websocket_too_many_messages_returns_TooManyMessagesError(
+    setup_users, setup_cookies, monkeypatch
+):
+    monkeypatch.setattr(get_settings(), "websocket_rate", 0.001)
+    monkeypatch.setattr(get_settings(), "websocket_burst", 2)
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect("/websocket/connect") as websocket:
+        websocket.receive_json()
+        for _ in range(2):
+            websocket.send_json({"payload": {"type": "unknown_type"}})
+            assert websocket.receive_json()["payload"] == UnknownTypeFieldError().json()
+        websocket.send_json({"payload": {"type": "unknown_type"}})
+        assert websocket.receive_json()["payload"] == TooManyMessagesError().json()
+
+
+def test_websocket_disconnect_policy_closes_connection(
+    setup_users, setup_cookies, monkeypatch
+):
+    monkeypatch.setattr(get_settings(), "websocket_abuse_policy", "disconnect")
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect("/websocket/connect") as websocket:
+        websocket.receive_json()
+        websocket.send_text("x" * (get_settings().websocket_max_frame_size + 1))
+        assert websocket.receive_json()["payload"] == FrameTooLargeError().json()
+        assert websocket.receive_json()["payload"]["status"] == "disconnected"
+        message = websocket.receive()
+        assert message["type"] == "websocket.close"
+        assert message["code"] == 1009
+    assert not connection_manager.has_session("session_id1")
+
+
+def test_websocket_releases_database_sessions(setup_users, setup_cookies):
+    sessions = []
+
+    def session_factory():
+        sessions.append(TestingSessionLocal())
+        return sessions[-1]
+
+    app.dependency_overrides[get_postgres_session_factory] = lambda: session_factory
+    try:
+        client.cookies.set("session_id", setup_users.user1.session_id)
+        with client.websocket_connect("/websocket/connect") as websocket:
+            websocket.receive_json()
+            assert sessions
+            assert not any(session.in_transaction() for session in sessions)
+    finally:
+        app.dependency_overrides[get_postgres_session_factory] = (
+            override_get_postgres_session_factory
+        )
+
+
+# MARK: -Watch
+
+
+def test_websocket_watch_receives_broadcaster_polls(websocket_connect):
+    websocket = websocket_connect
+    with client.websocket_connect("/websocket/watch/1") as viewer:
+        data = viewer.receive_json()
+        assert data == {"payload": {"type": "connection_status", "status": "connected"}}
+        websocket.send_json(
+            {
+                "payload": {
+                    "type": "poll",
+                    "data": {
+                        "type": "start",
+                        "data": {
+                            "title": "poll 1",
+                            "choices": ["choice1", "choice2"],
+                        },
+                    },
+                }
+            }
+        )
+        expected = {
+            "payload": {
+                "type": "poll",
+                "data": {"type": "start", "data": {"poll_id": "poll1"}},
+            }
+        }
+        assert websocket.receive_json() == expected
+        assert viewer.receive_json() == expected
+
+
+# MARK: -Resume
+
+
+def test_websocket_resume_skips_login_and_replays(
+    setup_users, setup_cookies, monkeypatch
+):
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect("/websocket/connect?resume=1") as websocket:
+        data = websocket.receive_json()
+        assert data["payload"]["resumed"] is False
+        resume_token = data["payload"]["resume_token"]
+        websocket.send_json(
+            {
+                "payload": {
+                    "type": "poll",
+                    "data": {"type": "get", "data": {"poll_id": "poll1"}},
+                }
+            }
+        )
+        assert websocket.receive_json()["seq"] == 1
+
+    async def is_token_valid(token: str, user_id: str) -> bool:
+        raise AssertionError("resume must not validate the token again")
+
+    monkeypatch.setattr(FakeTwitchClient, "is_token_valid", is_token_valid)
+    with client.websocket_connect(
+        f"/websocket/connect?resume_token={resume_token}&last_seq=0"
+    ) as websocket:
+        data = websocket.receive_json()
+        assert data["payload"]["resumed"] is True
+        replayed = websocket.receive_json()
+        assert replayed["seq"] == 1
+        assert replayed["payload"]["data"]["type"] == "get"
+        websocket.send_json({"payload": {"type": "disconnect"}})
+        assert websocket.receive_json()["payload"]["status"] == "disconnected"
+    assert not connection_manager.has_session("session_id1")
+
+
+def test_websocket_resume_negative_last_seq_starts_fresh(setup_users, setup_cookies):
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect("/websocket/connect?resume=1") as websocket:
+        resume_token = websocket.receive_json()["payload"]["resume_token"]
+        with client.websocket_connect(
+            f"/websocket/connect?resume_token={resume_token}&last_seq=-1"
+        ) as second_tab:
+            data = second_tab.receive_json()
+            assert data["payload"]["resumed"] is False
+            assert data["payload"]["resume_token"] != resume_token
+
+
+def test_websocket_delta_mode_answers_every_get_in_full(setup_users, setup_cookies):
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect("/websocket/connect?delta=1") as websocket:
+        websocket.receive_json()
+        for _ in range(2):
+            websocket.send_json(
+                {
+                    "payload": {
+                        "type": "poll",
+                        "data": {"type": "get", "data": {"poll_id": "poll1"}},
+                    }
+                }
+            )
+            data = websocket.receive_json()
+            assert data["payload"]["data"]["type"] == "get"
+
+
+# MARK: -Msgpack
+
+
+def test_websocket_msgpack_subprotocol(setup_users, setup_cookies):
+    client.cookies.set("session_id", setup_users.user1.session_id)
+    with client.websocket_connect(
+        "/websocket/connect", subprotocols=["msgpack"]
+    ) as websocket:
+        assert websocket.accepted_subprotocol == "msgpack"
+        data = msgpack.unpackb(websocket.receive_bytes())
+        assert data == {"payload": {"type": "connection_status", "status": "connected"}}
+        websocket.send_bytes(
+            msgpack.packb(
+                {
+                    "payload": {
+                        "type": "poll",
+                        "data": {"type": "get", "data": {"poll_id": "poll2"}},
+                    }
+                }
+            )
+        )
+        data = msgpack.unpackb(websocket.receive_bytes())
+        assert data["payload"] == PollNotFoundError().json()
+        websocket.send_bytes(b"\xc1")
+        data = msgpack.unpackb(websocket.receive_bytes())
+        assert data["payload"] == IncorrectWebsocketInputError().json()
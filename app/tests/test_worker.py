@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import WebSocket
+
+from app.routers.websocket import connect_websocket
+from app.schemas.users import User
+from app.tests.fixtures.fixtures_artifact import FakeTwitchClient
+from app.utils.broker import InMemoryBroker
+from app.utils.cache import IdempotencyCache
+from app.utils.concurrency import KeyedLimiter
+from app.utils.config import get_settings
+from app.utils.connection_manager import ConnectionManager
+from app.utils.eventsub import EventSubManager
+from app.utils.poll_watcher import PollWatcher
+from app.utils.worker import SOPApiWorker
+
+
+def test_worker_enables_websocket_pings():
+    assert SOPApiWorker.CONFIG_KWARGS["ws"] == "websockets"
+    assert (
+        SOPApiWorker.CONFIG_KWARGS["ws_ping_interval"]
+        == get_settings().websocket_ping_interval
+    )
+    assert (
+        SOPApiWorker.CONFIG_KWARGS["ws_ping_timeout"]
+        == get_settings().websocket_ping_timeout
+    )
+    assert (
+        SOPApiWorker.CONFIG_KWARGS["ws_per_message_deflate"]
+        == get_settings().websocket_per_message_deflate
+    )
+    assert (
+        SOPApiWorker.CONFIG_KWARGS["ws_max_size"]
+        == get_settings().websocket_max_message_size
+    )
+
+
+@pytest.mark.asyncio
+async def test_peer_dropped_by_ping_timeout_is_released(monkeypatch):
+    monkeypatch.setattr(get_settings(), "eventsub_enabled", False)
+    manager = ConnectionManager(InMemoryBroker())
+    watcher = PollWatcher(manager)
+    eventsub = EventSubManager(manager)
+    manager.on_session_closed(watcher.stop)
+    manager.on_session_closed(eventsub.close_session)
+    eventsub.sessions["1"] = {"session_id1"}
+    user = User(
+        user_id="1",
+        email="user1@test.com",
+        username="user1",
+        token="token1",
+        refresh_token="refresh_token1",
+        session_id="session_id1",
+    )
+
+    async def resolve_user(websocket: WebSocket) -> User:
+        return user
+
+    received: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def send(message: dict):
+        pass
+
+    websocket = WebSocket(
+        {
+            "type": "websocket",
+            "path": "/websocket/connect",
+            "headers": [(b"cookie", b"session_id=session_id1")],
+            "query_string": b"",
+            "subprotocols": [],
+        },
+        received.get,
+        send,
+    )
+    await received.put({"type": "websocket.connect"})
+    await received.put(
+        {
+            "type": "websocket.receive",
+            "text": json.dumps(
+                {
+                    "payload": {
+                        "type": "poll",
+                        "data": {
+                            "type": "start",
+                            "data": {"title": "poll 1", "choices": ["a", "b"]},
+                        },
+                    }
+                }
+            ),
+        }
+    )
+    task = asyncio.create_task(
+        connect_websocket(
+            websocket,
+            twitch_client=FakeTwitchClient,
+            resolve_user=resolve_user,
+            connection_manager=manager,
+            poll_watcher=watcher,
+            eventsub_manager=eventsub,
+            user_limiter=KeyedLimiter(limit=1),
+            poll_starts=IdempotencyCache(ttl=60),
+        )
+    )
+    while "session_id1" not in watcher.watches:
+        await asyncio.sleep(0.001)
+    assert manager.has_session("session_id1")
+    assert manager.members("1")
+
+    # What uvicorn hands to the app once a ping goes unanswered
+    await received.put({"type": "websocket.disconnect", "code": 1011})
+    await asyncio.wait_for(task, 1)
+    assert not manager.has_session("session_id1")
+    assert manager.rooms == {}
+    assert watcher.watches == {}
+    assert eventsub.sessions == {}
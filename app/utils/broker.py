@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from app.utils.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], Awaitable[None]]
+
+
+def get_reconnect_delay(attempt: int) -> float:
+    settings = get_settings()
+    return min(
+        settings.broker_reconnect_delay_max,
+        settings.broker_reconnect_delay * 2**attempt,
+    )
+
+
+class Broker(ABC):
+    @abstractmethod
+    async def start(self, handler: Handler): ...
+
+    @abstractmethod
+    async def stop(self): ...
+
+    @abstractmethod
+    async def publish(self, message: dict): ...
+
+
+class InMemoryBroker(Broker):
+    # Single process, several subscribers can share one instance to act as workers
+    def __init__(self):
+        self.handlers: list[Handler] = []
+
+    async def start(self, handler: Handler):
+        self.handlers.append(handler)
+
+    async def stop(self):
+        self.handlers.clear()
+
+    async def publish(self, message: dict):
+        for handler in list(self.handlers):
+            await handler(message)
+
+
+class PostgresBroker(Broker):
+    # NOTIFY payloads are limited to 8000 bytes, which fits websocket frames
+    max_payload_size = 8000
+
+    def __init__(self, dsn: str, channel: str):
+        self.dsn = dsn
+        self.channel = channel
+        self.handler: Handler | None = None
+        self.listen_connection = None
+        self.publish_connection = None
+        self.publish_lock = threading.Lock()
+        # Failed reconnections of the publish connection, and when to try again
+        self.publish_attempt = 0
+        self.publish_retry_at = 0.0
+        self.tasks: set[asyncio.Task] = set()
+        self.reconnect_task: asyncio.Task | None = None
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+        self.listen()
+        self.connect_publisher()
+
+    async def stop(self):
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+            self.reconnect_task = None
+        self.close_listener()
+        self.close_publisher()
+
+    def listen(self):
+        self.listen_connection = psycopg2.connect(self.dsn)
+        self.listen_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.listen_connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        asyncio.get_running_loop().add_reader(
+            self.listen_connection.fileno(), self.on_readable
+        )
+
+    def close_listener(self):
+        if self.listen_connection is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self.listen_connection.fileno())
+        except psycopg2.Error:
+            # The socket is already gone
+            pass
+        self.listen_connection.close()
+        self.listen_connection = None
+
+    async def reconnect(self):
+        attempt = 0
+        while True:
+            await asyncio.sleep(get_reconnect_delay(attempt))
+            try:
+                self.listen()
+            except psycopg2.Error as e:
+                logger.warning(f"Broker reconnection failed : {e}")
+                self.close_listener()
+                attempt += 1
+            else:
+                # Notifications sent while disconnected are lost
+                logger.warning("Broker reconnected")
+                self.reconnect_task = None
+                return
+
+    def on_readable(self):
+        try:
+            self.listen_connection.poll()
+        except psycopg2.Error as e:
+            # The reader would fire again and again on the dead socket
+            logger.warning(f"Broker connection lost : {e}")
+            self.close_listener()
+            self.reconnect_task = asyncio.create_task(self.reconnect())
+            return
+        while self.listen_connection.notifies:
+            notify = self.listen_connection.notifies.pop(0)
+            task = asyncio.create_task(self.handler(json.loads(notify.payload)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def publish(self, message: dict):
+        payload = json.dumps(message)
+        if len(payload.encode()) > self.max_payload_size:
+            logger.warning(f"Broker message of {len(payload)} bytes dropped")
+            return
+        try:
+            await asyncio.to_thread(self.notify, payload)
+        except psycopg2.Error as e:
+            # Local sockets already have the frame, only other workers miss it
+            logger.warning(f"Broker publish failed : {e}")
+
+    def notify(self, payload: str):
+        with self.publish_lock:
+            if self.publish_connection is None:
+                self.connect_publisher()
+            try:
+                with self.publish_connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+            except psycopg2.Error:
+                # Reopened by the next publish
+                self.close_publisher()
+                raise
+
+    def connect_publisher(self):
+        if time.monotonic() < self.publish_retry_at:
+            raise psycopg2.OperationalError("Broker publish connection is down")
+        try:
+            self.publish_connection = psycopg2.connect(self.dsn)
+            self.publish_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        except psycopg2.Error:
+            self.close_publisher()
+            self.publish_retry_at = time.monotonic() + get_reconnect_delay(
+                self.publish_attempt
+            )
+            self.publish_attempt += 1
+            raise
+        self.publish_attempt = 0
+
+    def close_publisher(self):
+        if self.publish_connection is None:
+            return
+        try:
+            self.publish_connection.close()
+        except psycopg2.Error:
+            pass
+        self.publish_connection = None
+
+
+def create_broker() -> Broker:
+    match get_settings().broker:
+        case "postgres":
+            from app.utils.database import postgres_url
+
+            return PostgresBroker(postgres_url, get_settings().broker_channel)
+        case _:
+            return InMemoryBroker()
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Any | None:
+        if (value := self.entries.get(key)) is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class TTLCache:
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Any | None:
+        if (entry := self.entries.get(key)) is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SingleFlight:
+    def __init__(self):
+        self.in_flight: dict[Hashable, asyncio.Task] = {}
+
+    async def do(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[Any]],
+        on_result: Callable[[Any], Any] | None = None,
+    ) -> Any:
+        task = self.in_flight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(func())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done, on_result))
+        # Shielded so that a cancelled caller doesn't cancel the shared call
+        return await asyncio.shield(task)
+
+    def _done(
+        self,
+        key: Hashable,
+        task: asyncio.Task,
+        on_result: Callable[[Any], Any] | None,
+    ):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # Runs even when every caller was cancelled meanwhile
+        if on_result and not task.cancelled() and task.exception() is None:
+            on_result(task.result())
+
+
+class IdempotencyCache:
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.results = TTLCache(ttl=ttl, maxsize=maxsize)
+        self.flights = SingleFlight()
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        # Duplicates share the first call while in flight, then its result.
+        # Failures aren't kept, so a retry after an error calls again.
+        if (result := self.results.get(key)) is not None:
+            return result
+        return await self.flights.do(
+            key, func, lambda result: self.results.set(key, result)
+        )
+
+    def clear(self):
+        self.results.clear()
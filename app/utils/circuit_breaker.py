@@ -0,0 +1,44 @@
+import time
+
+from app.utils.errors import TwitchUnavailableError
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_started_at: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            raise TwitchUnavailableError()
+        # Half-open : a single trial call probes Twitch, the others fail fast
+        if (
+            self.trial_started_at is not None
+            and now - self.trial_started_at < self.reset_timeout
+        ):
+            raise TwitchUnavailableError()
+        self.trial_started_at = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_started_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.trial_started_at = None
+
+    def reset(self):
+        self.record_success()
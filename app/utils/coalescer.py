@@ -0,0 +1,55 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+from app.utils.cache import LRUCache
+from app.utils.config import get_settings
+from app.utils.frames import Frame
+
+
+class Coalescer:
+    def __init__(self, maxsize: int = 4096):
+        # topic -> text of the last frame sent, to drop identical snapshots
+        self.last_sent = LRUCache(maxsize)
+        # topic -> newest frame held back while the topic's window is open
+        self.pending: dict[Hashable, Frame | None] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    async def submit(
+        self, topic: Hashable, frame: Frame, send: Callable[[Frame], Awaitable[None]]
+    ):
+        if topic in self.pending:
+            # Burst inside the window : only the newest frame goes out
+            self.pending[topic] = frame
+            return
+        if not self.mark_sent(topic, frame):
+            return
+        await send(frame)
+        if (window := get_settings().websocket_coalesce_window) > 0:
+            self.pending[topic] = None
+            task = asyncio.create_task(self.close_window(topic, window, send))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def close_window(
+        self, topic: Hashable, window: float, send: Callable[[Frame], Awaitable[None]]
+    ):
+        await asyncio.sleep(window)
+        frame = self.pending.pop(topic, None)
+        if frame is None or not self.mark_sent(topic, frame):
+            return
+        await send(frame)
+
+    def mark_sent(self, topic: Hashable, frame: Frame) -> bool:
+        # False when the topic's last frame was already this snapshot
+        if self.last_sent.get(topic) == frame.text:
+            return False
+        self.last_sent.set(topic, frame.text)
+        return True
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
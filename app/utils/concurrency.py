@@ -0,0 +1,52 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+from app.utils.cache import IdempotencyCache
+from app.utils.config import get_settings
+
+
+class KeyedLimiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphores: dict[Hashable, asyncio.Semaphore] = {}
+        self.holders: dict[Hashable, int] = {}
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable) -> AsyncIterator[None]:
+        if key not in self.semaphores:
+            self.semaphores[key] = asyncio.Semaphore(self.limit)
+            self.holders[key] = 0
+        semaphore = self.semaphores[key]
+        self.holders[key] += 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            # Semaphores only live while someone holds or waits on them
+            self.holders[key] -= 1
+            if not self.holders[key]:
+                del self.semaphores[key]
+                del self.holders[key]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def consume(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+user_limiter = KeyedLimiter(get_settings().twitch_user_concurrency)
+poll_starts = IdempotencyCache(ttl=get_settings().poll_start_idempotency_ttl)
@@ -1,5 +1,5 @@
 from functools import lru_cache
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -16,6 +16,63 @@ class Settings(BaseSettings):
     origins: list[str]
     cookie_domain: str = ""
     environment: Optional[str] = "production"
+    twitch_id_base_url: str = "https://id.twitch.tv"
+    twitch_api_base_url: str = "https://api.twitch.tv"
+    twitch_timeout: float = 5.0
+    twitch_timeouts: dict[str, float] = {
+        "validate": 3.0,
+        "get_users": 3.0,
+        "get_poll": 2.0,
+    }
+    twitch_retries: int = 2
+    twitch_backoff: float = 0.2
+    twitch_backoff_max: float = 2.0
+    twitch_breaker_threshold: int = 5
+    twitch_breaker_reset: float = 30.0
+    twitch_poll_cache_ttl: float = 1.0
+    twitch_finished_polls_cache_size: int = 1024
+    poll_watch_min_interval: float = 1.0
+    poll_watch_max_interval: float = 8.0
+    poll_watch_grace: float = 10.0
+    twitch_user_concurrency: int = 2
+    poll_start_idempotency_ttl: float = 600.0
+    websocket_send_queue_size: int = 32
+    websocket_overflow_policy: Literal["drop_oldest", "coalesce", "disconnect"] = (
+        "drop_oldest"
+    )
+    websocket_send_timeout: float = 10.0
+    websocket_flush_timeout: float = 2.0
+    websocket_validate_output: bool = False
+    websocket_coalesce_window: float = 0.05
+    websocket_coalesce_topics: int = 4096
+    websocket_max_in_flight: int = 8
+    websocket_max_frame_size: int = 4096
+    websocket_max_message_size: int = 65536
+    websocket_rate: float = 5.0
+    websocket_burst: int = 10
+    websocket_abuse_policy: Literal["error", "disconnect"] = "error"
+    websocket_resume_buffer_size: int = 256
+    websocket_resume_ttl: float = 120.0
+    websocket_max_inactivity: Optional[float] = None
+    websocket_stale_check_interval: float = 5.0
+    websocket_ping_interval: float = 10.0
+    websocket_ping_timeout: float = 10.0
+    websocket_per_message_deflate: bool = True
+    broker: Literal["memory", "postgres"] = "memory"
+    broker_channel: str = "sopapi_websocket"
+    broker_reconnect_delay: float = 1.0
+    broker_reconnect_delay_max: float = 30.0
+    eventsub_enabled: bool = False
+    twitch_eventsub_url: str = "wss://eventsub.wss.twitch.tv/ws"
+    # Defaults to the Helix endpoint under twitch_api_base_url
+    twitch_eventsub_subscriptions_url: Optional[str] = None
+    twitch_eventsub_welcome_timeout: float = 10.0
+    twitch_eventsub_keepalive_grace: float = 5.0
+    task_queue_workers: int = 4
+    task_queue_size: int = 1000
+    task_queue_retries: int = 3
+    task_queue_backoff: float = 1.0
+    task_queue_shutdown_timeout: float = 10.0
     model_config = SettingsConfigDict(extra="ignore")
 
 
@@ -1,54 +1,466 @@
+import asyncio
+import heapq
+import itertools
+import math
+import secrets
 import time
+from typing import Any, Callable
 
-from fastapi import WebSocket
+from fastapi import WebSocket, status
 
-from app.schemas.websocket import ActiveConnection, WebSocketOutput
+from app.schemas.users import User
+from app.schemas.websocket import ActiveConnection, ConnectionStatus
+from app.utils import frames
+from app.utils.broker import Broker, create_broker
+from app.utils.coalescer import Coalescer
+from app.utils.config import get_settings
+from app.utils.frames import Frame
+from app.utils.send_queue import OverflowPolicy, ReplayBuffer, SendQueue
+
+
+def negotiate_subprotocol(websocket: WebSocket) -> str | None:
+    # JSON text frames unless the client asks for msgpack
+    if frames.MSGPACK in websocket.scope.get("subprotocols", []):
+        return frames.MSGPACK
+    return None
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[str, ActiveConnection] = {}
+    def __init__(self, broker: Broker):
+        # session_id -> connection_id -> connection, one entry per open tab
+        self.active_connections: dict[str, dict[str, ActiveConnection]] = {}
+        # room -> connection_id -> connection, rooms are keyed by broadcaster id
+        self.rooms: dict[str, dict[str, ActiveConnection]] = {}
+        self.broker = broker
+        self.worker_id = secrets.token_hex(8)
+        # Min-heap of (deadline, sequence, connection)
+        self.deadlines: list[tuple[float, int, ActiveConnection]] = []
+        self.deadline_sequence = itertools.count()
+        # resume token -> connection kept for resume after its socket dropped
+        self.resumable: dict[str, ActiveConnection] = {}
+        self.session_closed_handlers: list[Callable[[str], Any]] = []
+        # Drops repeated poll snapshots and merges bursts per topic
+        self.coalescer = Coalescer(get_settings().websocket_coalesce_topics)
+
+    async def start(self):
+        await self.broker.start(self.receive_broker_message)
 
-    async def connect(self, session_id: str, websocket: WebSocket):
-        await websocket.accept()
-        connection = {"websocket": websocket, "last_seen": time.time()}
-        self.active_connections[session_id] = ActiveConnection.model_validate(
+    async def stop(self):
+        await self.broker.stop()
+        self.coalescer.stop()
+        for connection in self.connections():
+            self.stop_writer(connection)
+
+    def connections(self, session_id: str | None = None) -> list[ActiveConnection]:
+        if session_id is not None:
+            return list(self.active_connections.get(session_id, {}).values())
+        return [
             connection
+            for connections in self.active_connections.values()
+            for connection in connections.values()
+        ]
+
+    def get_connection(
+        self, session_id: str, connection_id: str
+    ) -> ActiveConnection | None:
+        return self.active_connections.get(session_id, {}).get(connection_id)
+
+    def has_session(self, session_id: str) -> bool:
+        return bool(self.active_connections.get(session_id))
+
+    def on_session_closed(self, handler: Callable[[str], Any]):
+        # Called with the session id once its last connection is gone
+        self.session_closed_handlers.append(handler)
+
+    async def connect(
+        self,
+        session_id: str,
+        websocket: WebSocket,
+        user: User | None = None,
+        resumable: bool = False,
+        delta: bool = False,
+        idle_timeout: bool = True,
+    ) -> str:
+        subprotocol = negotiate_subprotocol(websocket)
+        await websocket.accept(subprotocol)
+        connection = ActiveConnection.model_validate(
+            {
+                "session_id": session_id,
+                "connection_id": secrets.token_hex(8),
+                "websocket": websocket,
+                "last_seen": time.time(),
+                "queue": self.create_queue(),
+                "user": user,
+                "subprotocol": subprotocol,
+                # Replayed frames are full snapshots, so resume keeps them
+                "delta": delta and not resumable,
+                "idle_timeout": idle_timeout,
+            }
         )
-        await self.send_json(
-            session_id, {"type": "connection_status", "status": "connected"}
+        self.active_connections.setdefault(session_id, {})[
+            connection.connection_id
+        ] = connection
+        connection.writer = asyncio.create_task(self.write(connection))
+        self.schedule_deadline(connection)
+        if not resumable:
+            await self.send_frame(
+                session_id,
+                frames.connection_status(ConnectionStatus.CONNECTED),
+                connection.connection_id,
+            )
+            return connection.connection_id
+        connection.replay = ReplayBuffer(get_settings().websocket_resume_buffer_size)
+        self.resumable[connection.replay.token] = connection
+        connection.queue.put(frames.resume_status(connection.replay.token, False).text)
+        return connection.connection_id
+
+    async def resume(
+        self, session_id: str, websocket: WebSocket, resume_token: str, last_seq: int
+    ) -> ActiveConnection | None:
+        # No database or Twitch round trip: the token proves the earlier login
+        connection = self.resumable.get(resume_token)
+        if not connection or connection.session_id != session_id:
+            return None
+        if (missed := connection.replay.since(last_seq)) is None:
+            return None
+        if len(missed) + 1 > get_settings().websocket_send_queue_size:
+            # The send queue would drop part of the replay, start fresh instead
+            return None
+        if connection.detached_at is None:
+            # The old socket is not known to be dead yet, take it over
+            await self.detach(connection)
+        connection.subprotocol = negotiate_subprotocol(websocket)
+        await websocket.accept(connection.subprotocol)
+        connection.websocket = websocket
+        connection.detached_at = None
+        connection.last_seen = time.time()
+        connection.queue = self.create_queue()
+        connection.writer = asyncio.create_task(self.write(connection))
+        self.schedule_deadline(connection)
+        connection.queue.put(frames.resume_status(resume_token, True).text)
+        for text in missed:
+            connection.queue.put(text)
+        return connection
+
+    def create_queue(self) -> SendQueue:
+        settings = get_settings()
+        return SendQueue(
+            settings.websocket_send_queue_size,
+            OverflowPolicy(settings.websocket_overflow_policy),
         )
 
-    async def disconnect(self, session_id: str):
-        websocket = self.active_connections[session_id].websocket
-        await self.send_json(
-            session_id, {"type": "connection_status", "status": "disconnected"}
+    async def disconnect(
+        self,
+        session_id: str,
+        connection_id: str,
+        code: int = status.WS_1000_NORMAL_CLOSURE,
+    ):
+        if not (connection := self.get_connection(session_id, connection_id)):
+            return
+        await self.send_frame(
+            session_id,
+            frames.connection_status(ConnectionStatus.DISCONNECTED),
+            connection_id,
         )
-        await websocket.close()
-        del self.active_connections[session_id]
+        self.forget(connection)
+        await self.flush_connection(connection)
+        self.stop_writer(connection)
+        try:
+            await connection.websocket.close(code)
+        except RuntimeError:
+            # Already closed by the client or by a failed send
+            pass
+
+    def remove(self, session_id: str, connection_id: str):
+        # The client went away: nothing left to send
+        if connection := self.get_connection(session_id, connection_id):
+            self.forget(connection)
+            self.stop_writer(connection)
+
+    async def release(self, session_id: str, connection_id: str, websocket: WebSocket):
+        connection = self.get_connection(session_id, connection_id)
+        if not connection or connection.websocket is not websocket:
+            # Already gone or resumed on another socket
+            return
+        if connection.replay:
+            await self.detach(connection)
+        else:
+            self.remove(session_id, connection_id)
+
+    async def detach(self, connection: ActiveConnection):
+        # Stays registered so frames keep landing in the replay buffer
+        self.stop_writer(connection)
+        connection.queue = self.create_queue()
+        connection.detached_at = time.time()
+        self.schedule_deadline(connection)
+        try:
+            await connection.websocket.close()
+        except RuntimeError:
+            pass
+
+    def forget(self, connection: ActiveConnection):
+        for room in list(connection.rooms):
+            self.leave(room, connection)
+        if connection.replay:
+            self.resumable.pop(connection.replay.token, None)
+        connections = self.active_connections.get(connection.session_id, {})
+        if connections.get(connection.connection_id) is connection:
+            del connections[connection.connection_id]
+        if not connections and connection.session_id in self.active_connections:
+            del self.active_connections[connection.session_id]
+            for handler in self.session_closed_handlers:
+                handler(connection.session_id)
+
+    def subscribe(self, room: str, session_id: str, connection_id: str):
+        if connection := self.get_connection(session_id, connection_id):
+            self.rooms.setdefault(room, {})[connection_id] = connection
+            connection.rooms.add(room)
+
+    def unsubscribe(self, room: str, session_id: str, connection_id: str):
+        if connection := self.get_connection(session_id, connection_id):
+            self.leave(room, connection)
+
+    def leave(self, room: str, connection: ActiveConnection):
+        connection.rooms.discard(room)
+        members = self.rooms.get(room, {})
+        members.pop(connection.connection_id, None)
+        if not members:
+            self.rooms.pop(room, None)
+
+    def members(self, room: str, exclude: str | None = None) -> list[ActiveConnection]:
+        return [
+            connection
+            for connection_id, connection in self.rooms.get(room, {}).items()
+            if connection_id != exclude
+        ]
+
+    async def evict(self, connection: ActiveConnection):
+        if connection.replay:
+            # Missed frames are replayed if the client comes back in time
+            await self.detach(connection)
+            return
+        self.forget(connection)
+        self.stop_writer(connection)
+        try:
+            await connection.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except RuntimeError:
+            pass
+
+    def stop_writer(self, connection: ActiveConnection):
+        if connection.writer and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
 
-    async def send_json(self, session_id: str, payload: dict):
-        websocket = self.active_connections[session_id].websocket
-        data = WebSocketOutput.model_validate({"payload": payload})
-        await websocket.send_json(data.model_dump())
+    async def write(self, connection: ActiveConnection):
+        timeout = get_settings().websocket_send_timeout
+        while True:
+            key, data = await connection.queue.get()
+            if connection.delta and key is not None:
+                data = self.to_delta(connection, key, data)
+                if data is None:
+                    # Nothing changed since the last frame sent
+                    connection.queue.task_done()
+                    continue
+            if connection.subprotocol == frames.MSGPACK:
+                send = connection.websocket.send_bytes(frames.pack(data))
+            else:
+                send = connection.websocket.send_text(data)
+            try:
+                await asyncio.wait_for(send, timeout)
+            except Exception:
+                # Dead socket or consumer stuck on a full TCP buffer
+                connection.queue.task_done()
+                await self.evict(connection)
+                return
+            connection.queue.task_done()
 
-    def update_activity(self, session_id: str):
-        self.active_connections[session_id].last_seen = time.time()
+    def to_delta(self, connection: ActiveConnection, key: str, text: str) -> str | None:
+        # Computed against what this socket actually received, so frames
+        # dropped or coalesced in the queue never leave a gap
+        poll_id, votes, status = frames.snapshot(text)
+        previous = connection.poll_snapshots.get(key)
+        connection.poll_snapshots[key] = (votes, status)
+        if previous is None or len(previous[0]) != len(votes):
+            return text
+        if previous == (votes, status):
+            return None
+        return frames.poll_delta(poll_id, previous[0], votes, status).text
 
-    async def check_stale(self, max_inactivity: int = 300):
-        current_time = time.time()
-        to_close = []
-        for session_id, connection in self.active_connections.items():
-            if current_time - connection.last_seen > max_inactivity:
-                to_close.append(session_id)
+    async def flush_connection(self, connection: ActiveConnection):
+        try:
+            await asyncio.wait_for(
+                connection.queue.join(), get_settings().websocket_flush_timeout
+            )
+        except asyncio.TimeoutError:
+            pass
 
-        for session_id in to_close:
-            await self.disconnect(session_id)
+    async def flush(self, session_id: str):
+        await self.coalescer.drain()
+        await asyncio.gather(
+            *(
+                self.flush_connection(connection)
+                for connection in self.connections(session_id)
+            )
+        )
+
+    def queue_depth(self, session_id: str, connection_id: str) -> int:
+        if connection := self.get_connection(session_id, connection_id):
+            return connection.queue_depth
+        return 0
+
+    def queue_depths(self) -> dict[str, int]:
+        return {
+            connection.connection_id: connection.queue_depth
+            for connection in self.connections()
+        }
+
+    async def send_json(
+        self, session_id: str, payload: dict, connection_id: str | None = None
+    ):
+        await self.send_frame(session_id, frames.encode(payload), connection_id)
+
+    async def send_frame(
+        self, session_id: str, frame: Frame, connection_id: str | None = None
+    ):
+        if connection_id is not None:
+            # Reply to the socket that asked, always in full : delta mode and
+            # queue coalescing only apply to pushes
+            if connection := self.get_connection(session_id, connection_id):
+                await self.enqueue([connection], frame._replace(key=None))
+            return
+        if frame.key is not None:
+            await self.coalescer.submit(
+                ("session", session_id, frame.key),
+                frame,
+                lambda frame: self.publish_session(session_id, frame),
+            )
+            return
+        await self.publish_session(session_id, frame)
+
+    async def publish_session(self, session_id: str, frame: Frame):
+        await self.enqueue(self.connections(session_id), frame)
+        # Other tabs of the session may be held by another worker
+        await self.broker.publish(
+            {
+                "worker_id": self.worker_id,
+                "session_id": session_id,
+                "frame": frame.text,
+                "key": frame.key,
+            }
+        )
+
+    async def broadcast(self, room: str, payload: dict):
+        await self.broadcast_frame(room, frames.encode(payload))
+
+    async def broadcast_frame(
+        self, room: str, frame: Frame, exclude: str | None = None
+    ):
+        if frame.key is not None and exclude is None:
+            await self.coalescer.submit(
+                ("room", room, frame.key),
+                frame,
+                lambda frame: self.publish_room(room, frame),
+            )
+            return
+        await self.publish_room(room, frame, exclude)
+
+    async def publish_room(self, room: str, frame: Frame, exclude: str | None = None):
+        await self.enqueue(self.members(room, exclude), frame)
+        # Members of the room may be held by another worker
+        await self.broker.publish(
+            {
+                "worker_id": self.worker_id,
+                "room": room,
+                "frame": frame.text,
+                "key": frame.key,
+                "exclude": exclude,
+            }
+        )
+
+    async def enqueue(self, connections: list[ActiveConnection], frame: Frame):
+        # The same encoded text is queued for every connection
+        for connection in connections:
+            text = frame.text
+            if connection.replay:
+                text = connection.replay.stamp(text)
+                if connection.detached_at is not None:
+                    continue
+            if not connection.queue.put(text, frame.key):
+                await self.evict(connection)
+
+    async def receive_broker_message(self, message: dict):
+        if message["worker_id"] == self.worker_id:
+            return
+        frame = Frame(message["frame"], message["key"])
+        if "room" in message:
+            topic = ("room", message["room"], frame.key)
+            connections = self.members(message["room"], message.get("exclude"))
+        else:
+            topic = ("session", message["session_id"], frame.key)
+            connections = self.connections(message["session_id"])
+        # Several workers can publish the same snapshot, e.g. when each one
+        # holds a tab of the streamer and runs its own EventSub listener
+        if (
+            frame.key is not None
+            and not message.get("exclude")
+            and not self.coalescer.mark_sent(topic, frame)
+        ):
+            return
+        await self.enqueue(connections, frame)
+
+    def update_activity(self, session_id: str, connection_id: str):
+        # The heap entry is refreshed lazily when its old deadline pops
+        if connection := self.get_connection(session_id, connection_id):
+            connection.last_seen = time.time()
+
+    def deadline(self, connection: ActiveConnection) -> float:
+        settings = get_settings()
+        if connection.detached_at is not None:
+            return connection.detached_at + settings.websocket_resume_ttl
+        # Dead peers are dropped by the server pings, this only catches idlers
+        if settings.websocket_max_inactivity is None or not connection.idle_timeout:
+            return math.inf
+        return connection.last_seen + settings.websocket_max_inactivity
+
+    def schedule_deadline(self, connection: ActiveConnection):
+        if (deadline := self.deadline(connection)) == math.inf:
+            return
+        heapq.heappush(
+            self.deadlines,
+            (deadline, next(self.deadline_sequence), connection),
+        )
+
+    def pop_expired(self, current_time: float) -> list[ActiveConnection]:
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= current_time:
+            _, _, connection = heapq.heappop(self.deadlines)
+            if (
+                self.get_connection(connection.session_id, connection.connection_id)
+                is not connection
+            ):
+                # Already gone
+                continue
+            if self.deadline(connection) > current_time:
+                self.schedule_deadline(connection)
+                continue
+            expired.append(connection)
+        return expired
+
+    async def check_stale(self):
+        expired = self.pop_expired(time.time())
+        for connection in expired:
+            if connection.detached_at is not None:
+                # Resume window is over
+                self.forget(connection)
+        await asyncio.gather(
+            *(
+                self.disconnect(connection.session_id, connection.connection_id)
+                for connection in expired
+                if connection.detached_at is None
+            ),
+            return_exceptions=True,
+        )
 
-    # TODO: detect and close stale connections
-    # TODO: handle send fails
-    # TODO: KeyError
     # TODO: cleaning and proper testing
 
 
-connection_manager = ConnectionManager()
+connection_manager = ConnectionManager(create_broker())
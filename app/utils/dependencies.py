@@ -6,10 +6,15 @@ from fastapi.requests import HTTPConnection
 from sqlalchemy.orm import Session
 
 from app.crud.users import UsersCRUD
-from app.schemas.users import IsLoggedIn
+from app.schemas.users import IsLoggedIn, User
+from app.utils.cache import IdempotencyCache
+from app.utils.concurrency import KeyedLimiter, poll_starts, user_limiter
 from app.utils.connection_manager import ConnectionManager, connection_manager
 from app.utils.database import SessionLocal
-from app.utils.errors import UserNotFoundError
+from app.utils.errors import NotLoggedInError, UserNotFoundError
+from app.utils.eventsub import EventSubManager, eventsub_manager
+from app.utils.poll_watcher import PollWatcher, poll_watcher
+from app.utils.task_queue import TaskQueue, task_queue
 from app.utils.twitch import TwitchClient
 
 
@@ -21,6 +26,10 @@ def get_postgres_database() -> Generator[Session]:
         postgres_database.close()
 
 
+def get_postgres_session_factory() -> Callable[[], Session]:
+    return SessionLocal
+
+
 def get_state() -> str:
     return secrets.token_urlsafe(32)
 
@@ -33,23 +42,46 @@ def get_twitch_client() -> Generator[TwitchClient]:
     yield TwitchClient()
 
 
-def get_is_user_logged_in(
+def get_user_resolver(
     twitch_client: TwitchClient = Depends(get_twitch_client),
-    postgres_database: Session = Depends(get_postgres_database),
+    postgres_session_factory: Callable[[], Session] = Depends(
+        get_postgres_session_factory
+    ),
 ) -> Generator[Callable]:
-    async def is_user_logged_in(
-        http_connexion: HTTPConnection,
-    ) -> IsLoggedIn:
+    async def resolve_user(http_connexion: HTTPConnection) -> User:
         session_id = http_connexion.cookies.get("session_id")
         if not session_id:
-            return {"is_logged_in": False}
+            raise NotLoggedInError()
         try:
-            user = UsersCRUD(postgres_database).get_user(session_id)
-            is_logged_in = await twitch_client.is_token_valid(
-                user[0].token, user[0].user_id
-            )
-            return {"is_logged_in": is_logged_in}
+            # Websockets keep their dependencies open, so the session is not one
+            with postgres_session_factory() as postgres_database:
+                user = UsersCRUD(postgres_database).get_user(session_id)[0]
         except UserNotFoundError:
+            raise NotLoggedInError()
+        if not await twitch_client.is_token_valid(user.token, user.user_id):
+            raise NotLoggedInError()
+        return User.model_validate(user)
+
+    yield resolve_user
+
+
+async def get_current_user(
+    http_connexion: HTTPConnection,
+    resolve_user: Callable = Depends(get_user_resolver),
+) -> User:
+    return await resolve_user(http_connexion)
+
+
+def get_is_user_logged_in(
+    resolve_user: Callable = Depends(get_user_resolver),
+) -> Generator[Callable]:
+    async def is_user_logged_in(
+        http_connexion: HTTPConnection,
+    ) -> IsLoggedIn:
+        try:
+            await resolve_user(http_connexion)
+            return {"is_logged_in": True}
+        except NotLoggedInError:
             return {"is_logged_in": False}
 
     yield is_user_logged_in
@@ -57,3 +89,23 @@ def get_is_user_logged_in(
 
 def get_connection_manager() -> ConnectionManager:
     return connection_manager
+
+
+def get_poll_watcher() -> PollWatcher:
+    return poll_watcher
+
+
+def get_eventsub_manager() -> EventSubManager:
+    return eventsub_manager
+
+
+def get_task_queue() -> TaskQueue:
+    return task_queue
+
+
+def get_user_limiter() -> KeyedLimiter:
+    return user_limiter
+
+
+def get_poll_starts() -> IdempotencyCache:
+    return poll_starts
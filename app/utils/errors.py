@@ -90,6 +90,13 @@ class PollNotFoundError(SOPApiError):
         self.title = "Poll ID not found for this user"
 
 
+class TwitchUnavailableError(SOPApiError):
+    def __init__(self):
+        self.error_code = "T05"
+        self.status_code = 503
+        self.title = "Twitch is unavailable"
+
+
 # MARK: Websocket
 
 
@@ -97,7 +104,7 @@ class NotLoggedInError(SOPApiError):
     def __init__(self):
         self.error_code = "W01"
         self.status_code = 401
-        self.title = "Tried to connect to websocket while not logged in"
+        self.title = "Not logged in"
 
 
 class MissingTypeFieldError(SOPApiError):
@@ -142,6 +149,20 @@ class IncorrectWebsocketOutputError(SOPApiError):
         self.title = "Incorrect websocket output format"
 
 
+class FrameTooLargeError(SOPApiError):
+    def __init__(self):
+        self.error_code = "W08"
+        self.status_code = 413
+        self.title = "Websocket frame too large"
+
+
+class TooManyMessagesError(SOPApiError):
+    def __init__(self):
+        self.error_code = "W09"
+        self.status_code = 429
+        self.title = "Too many websocket messages"
+
+
 # MARK: Front End
 
 
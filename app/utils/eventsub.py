@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Awaitable, Callable
+
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import WebSocketException
+
+from app.schemas.websocket import PollOutputType, PollStatus
+from app.utils import frames
+from app.utils.config import get_settings
+from app.utils.connection_manager import ConnectionManager, connection_manager
+from app.utils.errors import SOPApiError
+from app.utils.twitch import TwitchClient, cache_poll, get_backoff
+
+logger = logging.getLogger(__name__)
+
+poll_begin = "channel.poll.begin"
+poll_progress = "channel.poll.progress"
+poll_end = "channel.poll.end"
+poll_subscription_types = (poll_begin, poll_progress, poll_end)
+
+
+class EventSubRevokedError(Exception):
+    pass
+
+
+def event_to_poll(subscription_type: str, event: dict) -> dict:
+    if subscription_type == poll_end:
+        status = event["status"].upper()
+    else:
+        status = PollStatus.ACTIVE.value
+    return {
+        "poll_id": event["id"],
+        "title": event["title"],
+        "choices": [
+            {"title": choice["title"], "votes": choice.get("votes", 0)}
+            for choice in event["choices"]
+        ],
+        "status": status,
+    }
+
+
+class EventSubListener:
+    def __init__(
+        self,
+        twitch_client: TwitchClient,
+        token: str,
+        user_id: str,
+        on_poll: Callable[[str, dict], Awaitable[None]],
+    ):
+        self.twitch_client = twitch_client
+        self.token = token
+        self.user_id = user_id
+        self.on_poll = on_poll
+        # Twitch may deliver a notification more than once
+        self.seen_messages: deque[str] = deque(maxlen=100)
+
+    async def run(self):
+        websocket: ClientConnection | None = None
+        url = get_settings().twitch_eventsub_url
+        attempt = 0
+        try:
+            while True:
+                try:
+                    new_websocket = await connect(url)
+                    session = await self.welcome(new_websocket)
+                    if websocket is None:
+                        await self.subscribe(session["id"])
+                    else:
+                        # Reconnect handover : subscriptions follow the session
+                        await websocket.close()
+                    websocket = new_websocket
+                    attempt = 0
+                    url = await self.listen(
+                        websocket, session["keepalive_timeout_seconds"]
+                    )
+                except (
+                    OSError,
+                    TimeoutError,
+                    WebSocketException,
+                    KeyError,
+                    ValueError,
+                    SOPApiError,
+                ) as e:
+                    logger.warning(f"EventSub session for {self.user_id} lost : {e}")
+                    if websocket is not None:
+                        await websocket.close()
+                    websocket = None
+                    url = get_settings().twitch_eventsub_url
+                    await asyncio.sleep(get_backoff(attempt))
+                    attempt += 1
+        except EventSubRevokedError:
+            logger.warning(f"EventSub subscription for {self.user_id} revoked")
+        finally:
+            if websocket is not None:
+                await websocket.close()
+
+    @staticmethod
+    async def welcome(websocket: ClientConnection) -> dict:
+        message = json.loads(
+            await asyncio.wait_for(
+                websocket.recv(), timeout=get_settings().twitch_eventsub_welcome_timeout
+            )
+        )
+        if message["metadata"]["message_type"] != "session_welcome":
+            raise ValueError("expected session_welcome")
+        return message["payload"]["session"]
+
+    async def subscribe(self, session_id: str):
+        await asyncio.gather(
+            *[
+                self.twitch_client.create_eventsub_subscription(
+                    token=self.token,
+                    user_id=self.user_id,
+                    session_id=session_id,
+                    subscription_type=subscription_type,
+                )
+                for subscription_type in poll_subscription_types
+            ]
+        )
+
+    async def listen(self, websocket: ClientConnection, keepalive: int) -> str:
+        # Keepalives arrive every `keepalive` seconds, silence means a dead session
+        timeout = keepalive + get_settings().twitch_eventsub_keepalive_grace
+        while True:
+            message = json.loads(
+                await asyncio.wait_for(websocket.recv(), timeout=timeout)
+            )
+            metadata = message["metadata"]
+            match metadata["message_type"]:
+                case "notification":
+                    if metadata["message_id"] in self.seen_messages:
+                        continue
+                    self.seen_messages.append(metadata["message_id"])
+                    subscription_type = metadata["subscription_type"]
+                    if subscription_type in poll_subscription_types:
+                        poll = event_to_poll(
+                            subscription_type, message["payload"]["event"]
+                        )
+                        cache_poll(self.user_id, poll)
+                        await self.on_poll(self.user_id, poll)
+                case "session_reconnect":
+                    return message["payload"]["session"]["reconnect_url"]
+                case "revocation":
+                    raise EventSubRevokedError()
+
+
+class EventSubManager:
+    def __init__(self, connection_manager: ConnectionManager):
+        self.connection_manager = connection_manager
+        self.listeners: dict[str, asyncio.Task] = {}
+        self.sessions: dict[str, set[str]] = {}
+
+    def add_session(
+        self, twitch_client: TwitchClient, token: str, user_id: str, session_id: str
+    ):
+        self.sessions.setdefault(user_id, set()).add(session_id)
+        if user_id not in self.listeners:
+            listener = EventSubListener(twitch_client, token, user_id, self.on_poll)
+            task = asyncio.create_task(listener.run())
+            self.listeners[user_id] = task
+            task.add_done_callback(lambda done: self._forget(user_id, done))
+
+    def remove_session(self, user_id: str, session_id: str):
+        sessions = self.sessions.get(user_id, set())
+        sessions.discard(session_id)
+        if not sessions:
+            self.sessions.pop(user_id, None)
+            if task := self.listeners.pop(user_id, None):
+                task.cancel()
+
+    def close_session(self, session_id: str):
+        for user_id, sessions in list(self.sessions.items()):
+            if session_id in sessions:
+                self.remove_session(user_id, session_id)
+
+    def _forget(self, user_id: str, task: asyncio.Task):
+        if self.listeners.get(user_id) is task:
+            del self.listeners[user_id]
+
+    async def on_poll(self, user_id: str, poll: dict):
+        await self.connection_manager.broadcast_frame(
+            user_id, frames.poll(PollOutputType.GET, poll)
+        )
+
+
+eventsub_manager = EventSubManager(connection_manager)
+connection_manager.on_session_closed(eventsub_manager.close_session)
@@ -0,0 +1,119 @@
+import json
+from functools import cache, lru_cache
+from typing import NamedTuple
+
+import msgpack
+
+from app.schemas.websocket import (
+    ConnectionStatus,
+    PollOutputType,
+    WebSocketOutput,
+    WebSocketOutputType,
+)
+from app.utils.config import get_settings
+from app.utils.errors import SOPApiError
+
+MSGPACK = "msgpack"
+
+
+class Frame(NamedTuple):
+    text: str
+    # Queued frames sharing a key can be coalesced into the newest one
+    key: str | None = None
+
+
+def encode(payload: dict, key: str | None = None) -> Frame:
+    if get_settings().websocket_validate_output:
+        WebSocketOutput.model_validate({"payload": payload})
+    return Frame(
+        json.dumps({"payload": payload}, separators=(",", ":"), ensure_ascii=False),
+        key,
+    )
+
+
+@cache
+def connection_status(status: ConnectionStatus) -> Frame:
+    return encode(
+        {"type": WebSocketOutputType.CONNECTION_STATUS.value, "status": status.value}
+    )
+
+
+def resume_status(resume_token: str, resumed: bool) -> Frame:
+    return encode(
+        {
+            "type": WebSocketOutputType.CONNECTION_STATUS.value,
+            "status": ConnectionStatus.CONNECTED.value,
+            "resume_token": resume_token,
+            "resumed": resumed,
+        }
+    )
+
+
+@lru_cache(maxsize=128)
+def _error(error_code: str, status_code: int, title: str) -> Frame:
+    return encode(
+        {
+            "type": WebSocketOutputType.ERROR.value,
+            "error_code": error_code,
+            "status_code": status_code,
+            "title": title,
+        }
+    )
+
+
+def error(error: SOPApiError) -> Frame:
+    return _error(error.error_code, error.status_code, error.title)
+
+
+def poll(output_type: PollOutputType, poll: dict) -> Frame:
+    return encode(
+        {
+            "type": WebSocketOutputType.POLL.value,
+            "data": {"type": output_type.value, "data": poll},
+        },
+        f"poll:{poll['poll_id']}" if output_type == PollOutputType.GET else None,
+    )
+
+
+def reply(frame: Frame, request_id: str | None) -> Frame:
+    # Appended to the encoded envelope so cached frames stay shared, a reply
+    # is never coalesced with other frames
+    if request_id is None:
+        return frame
+    return Frame(f'{frame.text[:-1]},"request_id":{json.dumps(request_id)}}}')
+
+
+@lru_cache(maxsize=1024)
+def pack(text: str) -> bytes:
+    # Converted once per frame, then shared by every msgpack connection
+    return msgpack.packb(json.loads(text))
+
+
+@lru_cache(maxsize=1024)
+def snapshot(text: str) -> tuple[str, tuple[int, ...], str]:
+    poll = json.loads(text)["payload"]["data"]["data"]
+    votes = tuple(choice["votes"] for choice in poll["choices"])
+    return poll["poll_id"], votes, poll["status"]
+
+
+@lru_cache(maxsize=1024)
+def poll_delta(
+    poll_id: str, previous: tuple[int, ...], votes: tuple[int, ...], status: str
+) -> Frame:
+    return encode(
+        {
+            "type": WebSocketOutputType.POLL.value,
+            "data": {
+                "type": PollOutputType.DELTA.value,
+                "data": {
+                    "poll_id": poll_id,
+                    "votes": {
+                        i: count
+                        for i, (before, count) in enumerate(zip(previous, votes))
+                        if before != count
+                    },
+                    "status": status,
+                },
+            },
+        }
+    )
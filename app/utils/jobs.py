@@ -0,0 +1,21 @@
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from app.crud.users import UsersCRUD
+from app.utils.twitch import TwitchClient
+
+
+async def refresh_user_profile(
+    twitch_client: TwitchClient,
+    postgres_session_factory: Callable[[], Session],
+    token: str,
+    user_id: str,
+):
+    username, email = await twitch_client.get_user(token, user_id)
+    with postgres_session_factory() as postgres_database:
+        UsersCRUD(postgres_database).update_profile(
+            user_id=user_id,
+            username=username,
+            email=email,
+        )
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from app.schemas.websocket import PollOutputType, PollStatus
+from app.utils import frames
+from app.utils.config import get_settings
+from app.utils.connection_manager import ConnectionManager, connection_manager
+from app.utils.errors import SOPApiError
+from app.utils.twitch import TwitchClient
+
+
+class PollWatcher:
+    def __init__(self, connection_manager: ConnectionManager):
+        self.connection_manager = connection_manager
+        self.watches: dict[str, asyncio.Task] = {}
+
+    def start(
+        self,
+        session_id: str,
+        twitch_client: TwitchClient,
+        token: str,
+        user_id: str,
+        poll_id: str,
+        duration: int,
+    ):
+        # Twitch runs one poll per channel at a time, a new poll replaces the watch
+        self.stop(session_id)
+        task = asyncio.create_task(
+            self.watch(session_id, twitch_client, token, user_id, poll_id, duration)
+        )
+        self.watches[session_id] = task
+        task.add_done_callback(lambda done: self._forget(session_id, done))
+
+    def stop(self, session_id: str):
+        if task := self.watches.pop(session_id, None):
+            task.cancel()
+
+    def _forget(self, session_id: str, task: asyncio.Task):
+        if self.watches.get(session_id) is task:
+            del self.watches[session_id]
+
+    async def watch(
+        self,
+        session_id: str,
+        twitch_client: TwitchClient,
+        token: str,
+        user_id: str,
+        poll_id: str,
+        duration: int,
+    ):
+        settings = get_settings()
+        interval = settings.poll_watch_min_interval
+        deadline = time.monotonic() + duration + settings.poll_watch_grace
+        last_poll = None
+        while time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            try:
+                poll = await twitch_client.get_poll(
+                    token=token, user_id=user_id, poll_id=poll_id
+                )
+            except SOPApiError:
+                interval = min(interval * 2, settings.poll_watch_max_interval)
+                continue
+
+            # Votes move fast : poll often, back off while nothing changes
+            if poll == last_poll:
+                interval = min(interval * 2, settings.poll_watch_max_interval)
+                continue
+            interval = settings.poll_watch_min_interval
+            last_poll = poll
+            await self.connection_manager.broadcast_frame(
+                user_id, frames.poll(PollOutputType.GET, poll)
+            )
+            if poll["status"] != PollStatus.ACTIVE.value:
+                return
+
+
+poll_watcher = PollWatcher(connection_manager)
+connection_manager.on_session_closed(poll_watcher.stop)
@@ -0,0 +1,91 @@
+import asyncio
+import secrets
+from collections import deque
+from enum import Enum
+from typing import Any, Hashable
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+
+class SendQueue:
+    def __init__(self, maxsize: int, policy: OverflowPolicy):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames: deque[tuple[Hashable | None, Any]] = deque()
+        self.pending = 0
+        self.ready = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def put(self, frame: Any, key: Hashable | None = None) -> bool:
+        # Returns False when the consumer is too slow and must be disconnected
+        if len(self.frames) >= self.maxsize:
+            match self.policy:
+                case OverflowPolicy.DISCONNECT:
+                    return False
+                case OverflowPolicy.COALESCE if key is not None and self.replace(
+                    key, frame
+                ):
+                    return True
+                case _:
+                    self.frames.popleft()
+                    self.pending -= 1
+        self.frames.append((key, frame))
+        self.pending += 1
+        self.ready.set()
+        self.drained.clear()
+        return True
+
+    def replace(self, key: Hashable, frame: Any) -> bool:
+        # Newer state of the same topic supersedes the queued one
+        for i, (queued_key, _) in enumerate(self.frames):
+            if queued_key == key:
+                self.frames[i] = (key, frame)
+                return True
+        return False
+
+    async def get(self) -> tuple[Hashable | None, Any]:
+        while not self.frames:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.frames.popleft()
+
+    def task_done(self):
+        self.pending -= 1
+        if self.pending <= 0:
+            self.pending = 0
+            self.drained.set()
+
+    async def join(self):
+        await self.drained.wait()
+
+
+class ReplayBuffer:
+    def __init__(self, maxsize: int):
+        self.token = secrets.token_urlsafe(24)
+        self.seq = 0
+        self.frames: deque[tuple[int, str]] = deque(maxlen=maxsize)
+
+    def stamp(self, text: str) -> str:
+        # Sequence number is appended to the encoded envelope
+        self.seq += 1
+        text = f'{text[:-1]},"seq":{self.seq}}}'
+        self.frames.append((self.seq, text))
+        return text
+
+    def since(self, last_seq: int) -> list[str] | None:
+        # None when frames after last_seq were already dropped
+        if last_seq < 0 or last_seq > self.seq:
+            return None
+        if last_seq < self.seq and (
+            not self.frames or self.frames[0][0] > last_seq + 1
+        ):
+            return None
+        return [text for seq, text in self.frames if seq > last_seq]
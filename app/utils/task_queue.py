@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from app.utils.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class TaskQueue:
+    def __init__(self, workers: int, maxsize: int, retries: int, backoff: float):
+        self.workers_count = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.workers: list[asyncio.Task] = []
+
+    def start(self):
+        self.workers = [
+            asyncio.create_task(self.work()) for _ in range(self.workers_count)
+        ]
+
+    async def stop(self, timeout: float):
+        # Gives pending jobs a chance to finish before shutting down
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except TimeoutError:
+            logger.warning(f"{self.queue.qsize()} background jobs dropped")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def enqueue(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> bool:
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except asyncio.QueueFull:
+            logger.warning(f"Background queue full, {func.__name__} dropped")
+            return False
+        return True
+
+    async def work(self):
+        while True:
+            func, args, kwargs = await self.queue.get()
+            try:
+                await self.run(func, args, kwargs)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, func: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict):
+        for attempt in range(1 + self.retries):
+            try:
+                await func(*args, **kwargs)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception(f"Background job {func.__name__} failed")
+                    return
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+
+task_queue = TaskQueue(
+    workers=get_settings().task_queue_workers,
+    maxsize=get_settings().task_queue_size,
+    retries=get_settings().task_queue_retries,
+    backoff=get_settings().task_queue_backoff,
+)
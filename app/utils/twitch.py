@@ -1,18 +1,32 @@
+import asyncio
+import random
+import time
+
 import httpx
 
+from app.schemas.websocket import PollStatus
+from app.utils.cache import LRUCache, SingleFlight, TTLCache
+from app.utils.circuit_breaker import CircuitBreaker
 from app.utils.config import get_settings
-from app.utils.errors import BaseError
+from app.utils.errors import BaseError, TwitchUnavailableError
 from app.utils.tools import data_to_query_parameters
 
 redirect_uri = f"{get_settings().base_url}/users/callback"
 
-authorization_base_url = "https://id.twitch.tv/oauth2/authorize"
-token_url = "https://id.twitch.tv/oauth2/token"
-validate_url = "https://id.twitch.tv/oauth2/validate"
+id_base_url = get_settings().twitch_id_base_url
+api_base_url = get_settings().twitch_api_base_url
+
+authorization_base_url = f"{id_base_url}/oauth2/authorize"
+token_url = f"{id_base_url}/oauth2/token"
+validate_url = f"{id_base_url}/oauth2/validate"
 
-get_users = "https://api.twitch.tv/helix/users"
-get_polls = "https://api.twitch.tv/helix/polls"
-create_poll = "https://api.twitch.tv/helix/polls"
+get_users = f"{api_base_url}/helix/users"
+get_polls = f"{api_base_url}/helix/polls"
+create_poll = f"{api_base_url}/helix/polls"
+eventsub_subscriptions = (
+    get_settings().twitch_eventsub_subscriptions_url
+    or f"{api_base_url}/helix/eventsub/subscriptions"
+)
 
 scope = " ".join(
     [
@@ -22,11 +36,99 @@ scope = " ".join(
 )
 response_type = "code"
 
+twitch_breaker = CircuitBreaker(
+    threshold=get_settings().twitch_breaker_threshold,
+    reset_timeout=get_settings().twitch_breaker_reset,
+)
+
+poll_flights = SingleFlight()
+recent_polls = TTLCache(ttl=get_settings().twitch_poll_cache_ttl)
+# Results of finished polls never change
+finished_polls = LRUCache(maxsize=get_settings().twitch_finished_polls_cache_size)
+finished_poll_statuses = {
+    PollStatus.COMPLETED.value,
+    PollStatus.TERMINATED.value,
+    PollStatus.ARCHIVED.value,
+}
+
+
+def cache_poll(user_id: str, poll: dict):
+    key = (user_id, poll["poll_id"])
+    if poll["status"] in finished_poll_statuses:
+        finished_polls.set(key, poll)
+    else:
+        recent_polls.set(key, poll)
+
+
+def get_backoff(attempt: int) -> float:
+    # Full jitter : spreads retries of concurrent callers
+    ceiling = min(
+        get_settings().twitch_backoff_max,
+        get_settings().twitch_backoff * 2**attempt,
+    )
+    return random.uniform(0, ceiling)
+
+
+def get_retry_after(response: httpx.Response) -> float | None:
+    # Seconds until the rate limit bucket refills, when Twitch says so
+    try:
+        if (retry_after := response.headers.get("Retry-After")) is not None:
+            return max(0.0, float(retry_after))
+        if (reset := response.headers.get("Ratelimit-Reset")) is not None:
+            return max(0.0, float(reset) - time.time())
+    except ValueError:
+        pass
+    return None
+
 
 class TwitchClient:
     def __init__(self):
         self.client = httpx.AsyncClient()
 
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        endpoint: str,
+        idempotent: bool = False,
+        **kwargs,
+    ) -> httpx.Response:
+        settings = get_settings()
+        timeout = settings.twitch_timeouts.get(endpoint, settings.twitch_timeout)
+        attempts = 1 + settings.twitch_retries if idempotent else 1
+        # One breaker outcome per call : retries of a single call are not
+        # several failures
+        twitch_breaker.before_call()
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                response = await self.client.request(
+                    method, url, timeout=timeout, **kwargs
+                )
+            except httpx.TransportError:
+                if last_attempt:
+                    twitch_breaker.record_failure()
+                    raise TwitchUnavailableError()
+                delay = get_backoff(attempt)
+            else:
+                if response.status_code >= 500:
+                    if last_attempt:
+                        twitch_breaker.record_failure()
+                        return response
+                    delay = get_backoff(attempt)
+                elif response.status_code == 429 and not last_attempt:
+                    delay = get_retry_after(response)
+                    if delay is None:
+                        delay = get_backoff(attempt)
+                    elif delay > settings.twitch_backoff_max:
+                        # Too long to hold the caller, let it see the 429
+                        twitch_breaker.record_success()
+                        return response
+                else:
+                    twitch_breaker.record_success()
+                    return response
+            await asyncio.sleep(delay)
+
     @staticmethod
     def get_authorization_url(state: str) -> str:
         return (
@@ -43,9 +145,11 @@ class TwitchClient:
             )
         )
 
-    async def callback(self, code: str) -> tuple[str, str, str]:
-        response = await self.client.post(
+    async def callback(self, code: str) -> tuple[str, str, str, str]:
+        response = await self._request(
+            "POST",
             token_url,
+            "token",
             headers={
                 "Content-Type": "application/x-www-form-urlencoded",
             },
@@ -57,13 +161,20 @@ class TwitchClient:
                 "code": code,
             },
         )
+        if response.status_code != 200:
+            raise BaseError("twitch callback")
         data = response.json()
         token = data["access_token"]
         refresh_token = data["refresh_token"]
         # expires_in = data["expires_in"]
 
-        response = await self.client.get(
+        # Validate is the lightest call giving the token owner, the profile
+        # (display name, email) is fetched later by a background job
+        response = await self._request(
+            "GET",
             validate_url,
+            "validate",
+            idempotent=True,
             headers={
                 "Authorization": f"Bearer {token}",
             },
@@ -73,12 +184,16 @@ class TwitchClient:
         else:
             data = response.json()
             user_id = data["user_id"]
+            login = data["login"]
 
-        return user_id, token, refresh_token
+        return user_id, login, token, refresh_token
 
     async def is_token_valid(self, token: str, user_id: str) -> bool:
-        response = await self.client.get(
+        response = await self._request(
+            "GET",
             get_users,
+            "get_users",
+            idempotent=True,
             headers={
                 "Authorization": f"Bearer {token}",
                 "Client-Id": get_settings().twitch_id,
@@ -88,8 +203,11 @@ class TwitchClient:
         return response.status_code == 200
 
     async def get_user(self, token: str, user_id: str) -> tuple[str, str]:
-        response = await self.client.get(
+        response = await self._request(
+            "GET",
             get_users,
+            "get_users",
+            idempotent=True,
             headers={
                 "Authorization": f"Bearer {token}",
                 "Client-Id": get_settings().twitch_id,
@@ -106,8 +224,20 @@ class TwitchClient:
         return username, email
 
     async def get_poll(self, token: str, user_id: str, poll_id: str) -> dict:
-        response = await self.client.get(
-            create_poll,
+        # Concurrent identical calls share one request, and its result for a moment
+        key = (user_id, poll_id)
+        if (poll := finished_polls.get(key) or recent_polls.get(key)) is not None:
+            return poll
+        return await poll_flights.do(
+            key, lambda: self._fetch_poll(token, user_id, poll_id)
+        )
+
+    async def _fetch_poll(self, token: str, user_id: str, poll_id: str) -> dict:
+        response = await self._request(
+            "GET",
+            get_polls,
+            "get_poll",
+            idempotent=True,
             headers={
                 "Authorization": f"Bearer {token}",
                 "Client-Id": get_settings().twitch_id,
@@ -128,9 +258,9 @@ class TwitchClient:
                 ],
                 "status": poll["status"],
             }
+            cache_poll(user_id, output)
         return output
 
-    # TODO custom duration
     async def create_poll(
         self,
         token: str,
@@ -139,13 +269,15 @@ class TwitchClient:
         choices: list[str],
         duration: int = 60,
     ) -> dict:
-        response = await self.client.post(
+        response = await self._request(
+            "POST",
             create_poll,
+            "create_poll",
             headers={
                 "Authorization": f"Bearer {token}",
                 "Client-Id": get_settings().twitch_id,
             },
-            data={
+            json={
                 "broadcaster_id": user_id,
                 "title": title,
                 "choices": [{"title": choice} for choice in choices],
@@ -161,13 +293,17 @@ class TwitchClient:
         return output
 
     async def end_poll(self, token: str, user_id: str, poll_id: str) -> dict:
-        response = await self.client.patch(
+        if (poll := finished_polls.get((user_id, poll_id))) is not None:
+            return poll
+        response = await self._request(
+            "PATCH",
             create_poll,
+            "end_poll",
             headers={
                 "Authorization": f"Bearer {token}",
                 "Client-Id": get_settings().twitch_id,
             },
-            data={"broadcaster_id": user_id, "id": poll_id, "status": "TERMINATED"},
+            json={"broadcaster_id": user_id, "id": poll_id, "status": "TERMINATED"},
         )
         if response.status_code != 200:
             raise BaseError("twitch end poll error")
@@ -183,4 +319,26 @@ class TwitchClient:
                 ],
                 "status": poll["status"],
             }
+            cache_poll(user_id, output)
         return output
+
+    async def create_eventsub_subscription(
+        self, token: str, user_id: str, session_id: str, subscription_type: str
+    ):
+        response = await self._request(
+            "POST",
+            eventsub_subscriptions,
+            "eventsub",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Client-Id": get_settings().twitch_id,
+            },
+            json={
+                "type": subscription_type,
+                "version": "1",
+                "condition": {"broadcaster_user_id": user_id},
+                "transport": {"method": "websocket", "session_id": session_id},
+            },
+        )
+        if response.status_code != 202:
+            raise BaseError("twitch eventsub subscription error")
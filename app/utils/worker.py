@@ -0,0 +1,17 @@
+from uvicorn.workers import UvicornWorker
+
+from app.utils.config import get_settings
+
+
+class SOPApiWorker(UvicornWorker):
+    # Only the "websockets" implementation sends server pings and tracks pongs,
+    # permessage-deflate is used when the client offers it
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "ws": "websockets",
+        "ws_ping_interval": get_settings().websocket_ping_interval,
+        "ws_ping_timeout": get_settings().websocket_ping_timeout,
+        "ws_per_message_deflate": get_settings().websocket_per_message_deflate,
+        # Hard ceiling, frames above websocket_max_frame_size are refused later
+        "ws_max_size": get_settings().websocket_max_message_size,
+    }
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import respx
+from httpx import Response
+
+from app.utils.twitch import TwitchClient
+
+# Simulated latency of every Twitch round trip, in seconds
+latency = 0.05
+logins = 20
+
+
+def delayed(response: Response):
+    async def side_effect(request):
+        await asyncio.sleep(latency)
+        return response
+
+    return side_effect
+
+
+async def main():
+    with respx.mock(assert_all_called=False) as respx_mock:
+        respx_mock.post("https://id.twitch.tv/oauth2/token").mock(
+            side_effect=delayed(
+                Response(200, json={"access_token": "token", "refresh_token": "r"})
+            )
+        )
+        respx_mock.get("https://id.twitch.tv/oauth2/validate").mock(
+            side_effect=delayed(Response(200, json={"user_id": "1", "login": "u"}))
+        )
+        respx_mock.get("https://api.twitch.tv/helix/users").mock(
+            side_effect=delayed(
+                Response(
+                    200,
+                    json={
+                        "data": [
+                            {
+                                "id": "1",
+                                "login": "u",
+                                "display_name": "U",
+                                "email": "u@test.com",
+                            }
+                        ]
+                    },
+                )
+            )
+        )
+        twitch_client = TwitchClient()
+        to_redirect = profile = 0.0
+        calls_to_redirect = calls = 0
+        for _ in range(logins):
+            # The callback runs before the redirect, the profile refresh is
+            # the background job queued by the route
+            start = time.perf_counter()
+            user_id, login, token, refresh_token = await twitch_client.callback("code")
+            redirected = time.perf_counter()
+            calls_to_redirect += len(respx_mock.calls)
+            await twitch_client.get_user(token, user_id)
+            to_redirect += redirected - start
+            profile += time.perf_counter() - redirected
+            calls += len(respx_mock.calls)
+            respx_mock.reset()
+
+    print(f"latency per round trip : {latency * 1000:.0f} ms")
+    print(
+        f"until redirect : {to_redirect / logins * 1000:.1f} ms, "
+        f"{calls_to_redirect / logins:.0f} Twitch calls"
+    )
+    print(
+        f"whole login : {(to_redirect + profile) / logins * 1000:.1f} ms, "
+        f"{calls / logins:.0f} Twitch calls"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
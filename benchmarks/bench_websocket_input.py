@@ -0,0 +1,38 @@
+import json
+import time
+
+from app.schemas.websocket import parse_websocket_input
+
+messages = 100_000
+
+payloads = [
+    {"payload": {"type": "disconnect"}},
+    {
+        "payload": {
+            "type": "poll",
+            "data": {
+                "type": "start",
+                "data": {"title": "poll 1", "choices": ["choice1", "choice2"]},
+            },
+        }
+    },
+    {"payload": {"type": "poll", "data": {"type": "get", "data": {"poll_id": "1"}}}},
+    {"payload": {"type": "poll", "data": {"type": "end", "data": {"poll_id": "1"}}}},
+]
+
+
+def main():
+    raw = [json.dumps(payload) for payload in payloads]
+    for text in raw:
+        parse_websocket_input(text)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        parse_websocket_input(raw[i % len(raw)])
+    elapsed = time.perf_counter() - start
+
+    print(f"websocket input : {messages / elapsed:,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()